@@ -0,0 +1,7 @@
+"""
+Benchmarks for Fandjango.
+
+Benchmarks are run against the test project's settings, e.g.::
+
+    $ DJANGO_SETTINGS_MODULE=tests.project.settings python -m benchmarks.paths
+"""
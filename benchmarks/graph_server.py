@@ -0,0 +1,201 @@
+"""
+A fake Graph API that answers the requests Fandjango makes of Facebook (exchanging codes and
+OAuth tokens, ``me``, ``me/permissions`` and pictures) with configurable latency, error rate and
+rate limiting, so that Fandjango may be load-tested against a slow Facebook without the network.
+
+OAuth tokens and codes are derived from the ID of the user they were issued to (``token-<id>``
+and ``code-<id>``), so any number of users may be simulated without configuring them first.
+
+Run it with ``python -m benchmarks.graph_server --help``.
+"""
+
+import argparse
+import json
+import random
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Lock
+from urlparse import urlparse, parse_qs
+
+PROFILE = {
+    'username': 'foobar',
+    'name': 'Foo Bar',
+    'first_name': 'Foo',
+    'last_name': 'Bar',
+    'birthday': '03/03/2000',
+    'email': 'foo@bar.com',
+    'locale': 'en_GB',
+    'gender': 'male',
+    'link': 'http://www.foo.com'
+}
+
+PERMISSIONS = ['installed', 'public_profile', 'email', 'checkins']
+
+class RateLimit(object):
+    """
+    RateLimit instances count calls in a sliding window the way Facebook does for applications,
+    reporting usage in the ``X-App-Usage`` header and refusing calls once usage exceeds 100%.
+    """
+
+    def __init__(self, calls, window=60):
+        """
+        :param calls: An integer describing how many calls are allowed per window, or ``None``.
+        :param window: An integer describing the length of the window in seconds.
+        """
+        self.calls = calls
+        self.window = window
+        self.timestamps = []
+        self.lock = Lock()
+
+    def hit(self):
+        """Count a call and return its usage of the limit in percent."""
+        if not self.calls:
+            return 0
+
+        now = time.time()
+
+        with self.lock:
+            self.timestamps = [timestamp for timestamp in self.timestamps if timestamp > now - self.window]
+            self.timestamps.append(now)
+
+            return len(self.timestamps) * 100 // self.calls
+
+class GraphServer(ThreadingMixIn, HTTPServer):
+    """Fake Graph API server that serves each request in a thread of its own."""
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.1, jitter=0.05, error_rate=0.0, rate_limit=None):
+        """
+        :param address: A tuple describing the host and port to listen on.
+        :param latency: A float describing the mean number of seconds to wait before responding.
+        :param jitter: A float describing the standard deviation of the latency.
+        :param error_rate: A float between 0 and 1 describing the ratio of requests to fail.
+        :param rate_limit: An integer describing how many calls are allowed per minute, or ``None``.
+        """
+        HTTPServer.__init__(self, address, GraphRequestHandler)
+
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = RateLimit(rate_limit)
+        self.calls = 0
+        self.lock = Lock()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+class GraphRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+
+        with self.server.lock:
+            self.server.calls += 1
+
+        time.sleep(max(0, random.gauss(self.server.latency, self.server.jitter)))
+
+        usage = self.server.rate_limit.hit()
+        headers = {
+            'X-App-Usage': json.dumps({'call_count': usage, 'total_time': usage, 'total_cputime': usage})
+        }
+
+        if usage > 100:
+            return self.error(400, 'OAuthException', 4, '(#4) Application request limit reached', headers)
+
+        if random.random() < self.server.error_rate:
+            return self.error(500, 'FacebookApiException', 2, 'An unexpected error has occurred.', headers)
+
+        path = url.path.strip('/').split('/')
+
+        if path == ['oauth', 'access_token']:
+            code = query.get('code') or query.get('fb_exchange_token')
+
+            if not code:
+                return self.error(400, 'OAuthException', 1, 'Missing code or token', headers)
+
+            return self.respond(200, 'access_token=token-%s&expires=5184000' % get_user_id(code), headers, 'text/plain')
+
+        user_id = get_user_id(query.get('access_token', ''))
+
+        if not user_id:
+            return self.error(400, 'OAuthException', 2500, 'An active access token must be used.', headers)
+
+        if path == ['me']:
+            return self.respond(200, json.dumps(dict(PROFILE, id=user_id)), headers)
+
+        if path == ['me', 'permissions']:
+            return self.respond(200, json.dumps({
+                'data': [{'permission': permission, 'status': 'granted'} for permission in PERMISSIONS]
+            }), headers)
+
+        if len(path) == 2 and path[1] == 'picture':
+            url = 'http://127.0.0.1/pictures/%s.jpg' % path[0]
+
+            if query.get('redirect') == 'false':
+                return self.respond(200, json.dumps({'data': {'url': url, 'is_silhouette': False}}), headers)
+
+            headers['Location'] = url
+            return self.respond(302, '', headers, 'text/plain')
+
+        return self.error(404, 'GraphMethodException', 100, 'Unsupported get request.', headers)
+
+    def error(self, status, type, code, message, headers):
+        self.respond(status, json.dumps({'error': {'message': message, 'type': type, 'code': code}}), headers)
+
+    def respond(self, status, body, headers, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def get_user_id(token):
+    """Return the ID of the user the given fake OAuth token or code was issued to, or ``None``."""
+    prefix, _, user_id = token.partition('-')
+
+    if prefix in ('token', 'code') and user_id.isdigit():
+        return user_id
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Serve a fake Graph API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.1, help='mean latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.05, help='standard deviation of the latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='ratio of requests to fail, from 0 to 1')
+    parser.add_argument('--rate-limit', type=int, default=None, help='calls allowed per minute')
+    return parser
+
+def main():
+    arguments = get_parser().parse_args()
+
+    server = GraphServer(
+        (arguments.host, arguments.port),
+        latency = arguments.latency,
+        jitter = arguments.jitter,
+        error_rate = arguments.error_rate,
+        rate_limit = arguments.rate_limit
+    )
+
+    print('Serving a fake Graph API at %s' % server.url)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+"""
+Load-test the test project against the fake Graph API in ``benchmarks.graph_server``, serving it
+with a fixed number of worker threads while a number of clients request it concurrently, and report
+throughput, tail latency and how saturated the workers were.
+
+Run it with ``python -m benchmarks.load --help``.
+"""
+
+import argparse
+import os
+import random
+import time
+from Queue import Queue
+from threading import Lock, Thread
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+import requests
+
+from benchmarks.graph_server import GraphServer
+
+class PooledWSGIServer(WSGIServer):
+    """
+    WSGI server that serves requests with a fixed number of worker threads, recording how long each
+    request waited for a worker and how long the workers were busy.
+    """
+
+    request_queue_size = 128
+
+    def __init__(self, address, application, workers):
+        WSGIServer.__init__(self, address, QuietWSGIRequestHandler)
+
+        self.set_app(application)
+        self.workers = workers
+        self.waits = []
+        self.busy = 0.0
+        self.lock = Lock()
+        self.requests = Queue()
+
+        for i in range(workers):
+            thread = Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address, time.time()))
+
+    def work(self):
+        while True:
+            request, client_address, queued_at = self.requests.get()
+            started_at = time.time()
+
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                pass
+            finally:
+                self.shutdown_request(request)
+
+            with self.lock:
+                self.waits.append(started_at - queued_at)
+                self.busy += time.time() - started_at
+
+    def handle_error(self, request, client_address):
+        pass
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+def get_scenarios(url):
+    """
+    Return a list of tuples describing the name, weight and a function that issues the request
+    of each scenario, given the URL of the test project.
+    """
+    from benchmarks.middleware import get_signed_request
+
+    visitors = iter(xrange(10 ** 6, 10 ** 7))
+    returning = range(1, 101)
+
+    def returning_canvas(session):
+        return session.post(url, data={'signed_request': get_signed_request(random.choice(returning))})
+
+    def first_canvas(session):
+        return session.post(url, data={'signed_request': get_signed_request(next(visitors))})
+
+    def permissions(session):
+        return session.post(url + 'places', data={'signed_request': get_signed_request(random.choice(returning))})
+
+    def first_web(session):
+        return session.get(url, params={'code': 'code-%d' % next(visitors)}, allow_redirects=False)
+
+    def returning_web(session):
+        return session.get(url, cookies={'oauth_token': 'token-%d' % random.choice(returning)})
+
+    return [
+        ('canvas: returning user', 60, returning_canvas),
+        ('canvas: first visit', 10, first_canvas),
+        ('canvas: permissions', 10, permissions),
+        ('web: first visit', 10, first_web),
+        ('web: returning user', 10, returning_web)
+    ]
+
+def percentile(durations, percent):
+    """Return the given percentile of the given sorted list of durations."""
+    if not durations:
+        return 0
+    return durations[min(len(durations) - 1, int(len(durations) * percent / 100.0))]
+
+def client(scenarios, deadline, results):
+    """Issue requests of randomly chosen scenarios until the given deadline, appending the outcome of each to ``results``."""
+    session = requests.Session()
+    choices = [scenario for scenario in scenarios for i in range(scenario[1])]
+
+    while time.time() < deadline:
+        name, weight, issue = random.choice(choices)
+
+        # Every request is issued by a different visitor
+        session.cookies.clear()
+
+        started_at = time.time()
+
+        try:
+            failed = issue(session).status_code >= 500
+        except requests.RequestException:
+            failed = True
+
+        results.append((name, time.time() - started_at, failed))
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Load-test the test project against a fake Graph API.')
+    parser.add_argument('--clients', type=int, default=20, help='number of concurrent clients')
+    parser.add_argument('--workers', type=int, default=8, help='number of threads serving the test project')
+    parser.add_argument('--duration', type=float, default=10, help='number of seconds to run for')
+    parser.add_argument('--graph-url', default=None, help='URL of a running fake Graph API to use instead of starting one')
+    parser.add_argument('--latency', type=float, default=0.1, help='mean latency of the Graph API in seconds')
+    parser.add_argument('--jitter', type=float, default=0.05, help='standard deviation of the latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='ratio of Graph API requests to fail, from 0 to 1')
+    parser.add_argument('--rate-limit', type=int, default=None, help='Graph API calls allowed per minute')
+    return parser
+
+def main():
+    arguments = get_parser().parse_args()
+
+    graph_server = None
+
+    if not arguments.graph_url:
+        graph_server = GraphServer(
+            ('127.0.0.1', 0),
+            latency = arguments.latency,
+            jitter = arguments.jitter,
+            error_rate = arguments.error_rate,
+            rate_limit = arguments.rate_limit
+        )
+        Thread(target=graph_server.serve_forever).start()
+
+    os.environ['FANDJANGO_GRAPH_API_URL'] = arguments.graph_url or graph_server.url
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.core.wsgi import get_wsgi_application
+    from fandjango.tasks import executor
+    from fandjango.graph import transport
+
+    if os.path.exists(settings.DATABASES['default']['NAME']):
+        os.remove(settings.DATABASES['default']['NAME'])
+
+    call_command('syncdb', interactive=False, verbosity=0)
+    call_command('migrate', interactive=False, verbosity=0)
+
+    server = PooledWSGIServer(('127.0.0.1', 0), get_wsgi_application(), arguments.workers)
+    Thread(target=server.serve_forever).start()
+
+    url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    scenarios = get_scenarios(url)
+
+    # Register the returning users before the clock starts.
+    session = requests.Session()
+    for user_id in range(1, 101):
+        session.get(url, params={'code': 'code-%d' % user_id}, allow_redirects=False)
+    executor.drain(30)
+
+    with server.lock:
+        server.waits, server.busy = [], 0.0
+
+    results = []
+    deadline = time.time() + arguments.duration
+    clients = [Thread(target=client, args=(scenarios, deadline, results)) for i in range(arguments.clients)]
+
+    started_at = time.time()
+
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+
+    elapsed = time.time() - started_at
+    backlog = executor.queue.qsize()
+
+    server.shutdown()
+    executor.drain(30)
+
+    if graph_server:
+        graph_server.shutdown()
+
+    print('%d clients, %d workers, %.0f seconds' % (arguments.clients, arguments.workers, elapsed))
+    print('%-24s %8s %8s %9s %9s %9s %7s' % ('', 'requests', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'errors'))
+
+    for name in [scenario[0] for scenario in scenarios] + ['total']:
+        outcomes = [result for result in results if name in (result[0], 'total')]
+        durations = sorted(duration for _, duration, _ in outcomes)
+
+        print('%-24s %8d %8.1f %9.1f %9.1f %9.1f %7d' % (
+            name,
+            len(outcomes),
+            len(outcomes) / elapsed,
+            percentile(durations, 50) * 1000,
+            percentile(durations, 90) * 1000,
+            percentile(durations, 99) * 1000,
+            len([failed for _, _, failed in outcomes if failed])
+        ))
+
+    waits = sorted(server.waits)
+
+    print('')
+    print('worker utilization       %8.0f%%' % (server.busy / (arguments.workers * elapsed) * 100))
+    print('wait for a worker        %8.1f ms p50 %8.1f ms p99' % (percentile(waits, 50) * 1000, percentile(waits, 99) * 1000))
+    print('background queue         %8d tasks' % backlog)
+
+    if graph_server:
+        print('graph api calls          %8d' % graph_server.calls)
+
+    for host, statistics in transport.get_statistics().items():
+        print('graph api connections    %8d for %d requests to %s' % (statistics['connections'], statistics['requests'], host))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+Measure what Fandjango's middleware costs per request, driving ``FacebookMiddleware`` and
+``FacebookWebMiddleware`` with requests built by Django's ``RequestFactory`` and a stubbed
+``GraphAPI`` so that Facebook's latency doesn't factor into the results.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+from time import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, reset_queries
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+
+from fandjango.middleware import FacebookMiddleware, FacebookWebMiddleware
+from fandjango.utils import PathMatcher
+
+from facepy import GraphAPI
+from mock import patch
+
+PROFILE = {
+    'username': 'foobar',
+    'name': 'Foo Bar',
+    'first_name': 'Foo',
+    'last_name': 'Bar',
+    'birthday': '03/03/2000',
+    'email': 'foo@bar.com',
+    'locale': 'en_GB',
+    'gender': 'male',
+    'link': 'http://www.foo.com'
+}
+
+request_factory = RequestFactory()
+
+def get_signed_request(user_id, expires_in=999999):
+    """Generate a signed request issued by the given user on behalf of the test project's application."""
+    payload = {
+        'algorithm': 'HMAC-SHA256',
+        'user': {
+            'country': 'uk',
+            'locale': 'en_GB'
+        },
+        'oauth_token': 'token-%d' % user_id,
+        'expires': int(time()) + expires_in,
+        'issued_at': int(time()),
+        'user_id': user_id
+    }
+
+    encoded_payload = base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')))
+
+    encoded_signature = base64.urlsafe_b64encode(hmac.new(
+        str(settings.FACEBOOK_APPLICATION_SECRET_KEY), encoded_payload, hashlib.sha256
+    ).digest())
+
+    return '%s.%s' % (encoded_signature, encoded_payload)
+
+def graph_get(graph, path, *args, **kwargs):
+    """Stand in for ``GraphAPI.get``, answering for the user the OAuth token or code was issued to."""
+    if path == 'oauth/access_token':
+        code = kwargs.get('code') or kwargs.get('fb_exchange_token')
+        return 'access_token=token-%s&expires=5184000' % code.split('-')[1]
+
+    return dict(PROFILE, id=graph.oauth_token.split('-')[1])
+
+def canvas(signed_request=None, path=None):
+    """Return a function that builds a canvas request, optionally with the given signed request."""
+    def build():
+        if signed_request is None:
+            return request_factory.get(path or reverse('home'))
+
+        return request_factory.post(path or reverse('home'), {'signed_request': signed_request})
+    return build
+
+def web(oauth_token=None, code=None):
+    """Return a function that builds a website request with the given OAuth token cookie or authorization code."""
+    def build():
+        if code:
+            return request_factory.get(reverse('home'), {'code': code})
+
+        request = request_factory.get(reverse('home'))
+        request.COOKIES['oauth_token'] = oauth_token
+        return request
+    return build
+
+def get_scenarios(number):
+    """
+    Return a list of tuples describing the name of each scenario, the middleware it exercises and
+    a list of functions that build the requests to time, along with requests to warm up with.
+    """
+    visitors = range(1000, 1000 + number)
+
+    return [
+        ('canvas: anonymous', FacebookMiddleware(),
+            [], [canvas()] * number),
+        ('canvas: returning user', FacebookMiddleware(),
+            [canvas(get_signed_request(1))], [canvas(get_signed_request(1))] * number),
+        ('canvas: first visit', FacebookMiddleware(),
+            [], [canvas(get_signed_request(user_id)) for user_id in visitors]),
+        ('canvas: expired token', FacebookMiddleware(),
+            [], [canvas(get_signed_request(1, expires_in=-60))] * number),
+        ('canvas: disabled path', FacebookMiddleware(),
+            [], [canvas(get_signed_request(1), path='/static/app.css')] * number),
+        ('web: anonymous', FacebookWebMiddleware(),
+            [], [web(oauth_token='unknown')] * number),
+        ('web: returning user', FacebookWebMiddleware(),
+            [web(code='code-1')], [web(oauth_token='token-1')] * number),
+        ('web: first visit', FacebookWebMiddleware(),
+            [], [web(code='code-%d' % user_id) for user_id in visitors]),
+    ]
+
+def percentile(durations, percent):
+    """Return the given percentile of the given sorted list of durations."""
+    return durations[min(len(durations) - 1, int(len(durations) * percent / 100.0))]
+
+def run(middleware, warmup, requests):
+    """
+    Process the given requests with the given middleware and return a tuple of the
+    duration of each request and the number of queries made.
+    """
+    for build in warmup:
+        request = build()
+        middleware.process_request(request)
+        middleware.process_response(request, HttpResponse())
+
+    requests = [build() for build in requests]
+    durations = []
+
+    reset_queries()
+
+    for request in requests:
+        start = time()
+        middleware.process_request(request)
+        middleware.process_response(request, HttpResponse())
+        durations.append(time() - start)
+
+    return durations, len(connection.queries)
+
+def main(number=500):
+    call_command('syncdb', interactive=False, verbosity=0)
+    call_command('migrate', interactive=False, verbosity=0)
+
+    print('%d requests per scenario' % number)
+    print('%-24s %10s %9s %9s %9s %9s' % ('', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'queries'))
+
+    with patch.object(GraphAPI, 'get', graph_get):
+        with patch('fandjango.middleware.DISABLED_PATHS', [r'^static/']):
+            with patch('fandjango.middleware.is_disabled_path', PathMatcher([r'^static/']).match):
+                for name, middleware, warmup, requests in get_scenarios(number):
+                    call_command('flush', interactive=False, verbosity=0)
+                    cache.clear()
+
+                    durations, queries = run(middleware, warmup, requests)
+                    durations.sort()
+
+                    print('%-24s %10.0f %9.3f %9.3f %9.3f %9.2f' % (
+                        name,
+                        len(durations) / sum(durations),
+                        percentile(durations, 50) * 1000,
+                        percentile(durations, 90) * 1000,
+                        percentile(durations, 99) * 1000,
+                        float(queries) / len(durations)
+                    ))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""
+Compare matching paths against ``FANDJANGO_DISABLED_PATHS`` one pattern at a time
+with matching them against Fandjango's compiled ``PathMatcher``.
+"""
+
+import re
+from timeit import timeit
+
+from fandjango.utils import PathMatcher
+
+PATTERNS = [r'^static/%d/' % i for i in range(50)] + [r'^api/v%d/' % i for i in range(10)]
+
+PATHS = ['/static/%d/app.css' % i for i in range(0, 50, 5)] + ['/canvas/%d' % i for i in range(40)]
+
+def search(patterns, path):
+    """Match the path the way Fandjango used to, calling ``re.search`` for every pattern."""
+    for pattern in patterns:
+        if re.search(pattern, path[1:]):
+            return True
+    return False
+
+def main(number=200):
+    matcher = PathMatcher(PATTERNS)
+
+    candidates = [
+        ('re.search per pattern', lambda: [search(PATTERNS, path) for path in PATHS]),
+        ('PathMatcher', lambda: [matcher.match(path) for path in PATHS])
+    ]
+
+    print('%d patterns, %d paths, %d rounds' % (len(PATTERNS), len(PATHS), number))
+
+    for name, function in candidates:
+        seconds = timeit(function, number=number)
+        print('%-24s %8.2f us/path' % (name, seconds / (number * len(PATHS)) * 1e6))
+
+if __name__ == '__main__':
+    main()
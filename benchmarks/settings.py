@@ -0,0 +1,31 @@
+"""
+Settings for load-testing the test project against the fake Graph API in ``benchmarks.graph_server``.
+"""
+
+import os
+import tempfile
+
+from tests.project.settings import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('FANDJANGO_BENCHMARK_DATABASE', os.path.join(tempfile.gettempdir(), 'fandjango-benchmark.sqlite3')),
+        'OPTIONS': {
+            'timeout': 30
+        }
+    }
+}
+
+MIDDLEWARE_CLASSES = [
+    'fandjango.middleware.FacebookMiddleware',
+    'fandjango.middleware.FacebookWebMiddleware'
+]
+
+DEBUG = False
+
+ALLOWED_HOSTS = ['*']
+
+FANDJANGO_GRAPH_API_URL = os.environ.get('FANDJANGO_GRAPH_API_URL', 'http://127.0.0.1:8001')
+
+FANDJANGO_BACKGROUND_WORKERS = 1
@@ -11,7 +11,7 @@ from fandjango.settings import FACEBOOK_APPLICATION_NAMESPACE
 from fandjango.settings import FACEBOOK_APPLICATION_INITIAL_PERMISSIONS
 from fandjango.settings import FACEBOOK_AUTHORIZATION_REDIRECT_URL
 
-def facebook_authorization_required(redirect_uri=FACEBOOK_AUTHORIZATION_REDIRECT_URL, permissions=None):
+def facebook_authorization_required(redirect_uri=FACEBOOK_AUTHORIZATION_REDIRECT_URL, permissions=None, synchronize=False):
     """
     Require the user to authorize the application.
 
@@ -20,6 +20,8 @@ def facebook_authorization_required(redirect_uri=FACEBOOK_AUTHORIZATION_REDIRECT
                          (e.g. ``http://apps.facebook.com/myapp/current/path``). Defaults to
                          ``FACEBOOK_AUTHORIZATION_REDIRECT_URL`` (which, in turn, defaults to ``None``).
     :param permissions: A list of strings describing Facebook permissions.
+    :param synchronize: A boolean describing whether to synchronize users that have not been
+                        synchronized with Facebook yet before calling the view.
     """
 
     def decorator(function):
@@ -27,14 +29,22 @@ def facebook_authorization_required(redirect_uri=FACEBOOK_AUTHORIZATION_REDIRECT
         def wrapper(request, *args, **kwargs):
 
             # We know the user has been authenticated via a canvas page if a signed request is set.
-            canvas = request.facebook is not False and hasattr(request.facebook, "signed_request")
+            canvas = bool(request.facebook and request.facebook.signed_request)
 
             # The user has already authorized the application, but the given view requires
             # permissions besides the defaults listed in ``FACEBOOK_APPLICATION_DEFAULT_PERMISSIONS``.
             #
             # Derive a list of outstanding permissions and prompt the user to grant them.
             if request.facebook and request.facebook.user and permissions:
-                outstanding_permissions = [p for p in permissions if p not in request.facebook.user.permissions]
+                synchronized_at = request.facebook.user.permissions_synchronized_at
+                granted_permissions = request.facebook.user.get_granted_permissions()
+                outstanding_permissions = [p for p in permissions if p not in granted_permissions]
+
+                # The user may have granted them since his/her permissions were synchronized,
+                # unless they were synchronized just now.
+                if outstanding_permissions and request.facebook.user.permissions_synchronized_at == synchronized_at:
+                    granted_permissions = request.facebook.user.get_granted_permissions(refresh=True)
+                    outstanding_permissions = [p for p in permissions if p not in granted_permissions]
 
                 if outstanding_permissions:
                     return authorize_application(
@@ -53,6 +63,11 @@ def facebook_authorization_required(redirect_uri=FACEBOOK_AUTHORIZATION_REDIRECT
                     permissions = (FACEBOOK_APPLICATION_INITIAL_PERMISSIONS or []) + (permissions or [])
                 )
 
+            # New users are synchronized with Facebook in the background, but the view
+            # requires their details right away.
+            if synchronize and not request.facebook.user.synchronized_at:
+                request.facebook.user.synchronize()
+
             return function(request, *args, **kwargs)
         return wrapper
 
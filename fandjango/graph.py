@@ -0,0 +1,345 @@
+import os
+import json
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from threading import Lock, local
+from urllib import urlencode
+
+from facepy import GraphAPI, FacebookError
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from fandjango.settings import FACEBOOK_APPLICATION_ID, FACEBOOK_APPLICATION_SECRET_KEY
+from fandjango.settings import GRAPH_API_URL, GRAPH_API_TIMEOUT, GRAPH_API_CONNECT_TIMEOUT, GRAPH_API_RETRIES
+from fandjango.settings import GRAPH_API_POOL_SIZE, GRAPH_API_CONCURRENCY
+
+# The maximum number of requests Facebook accepts in a single batch.
+BATCH_SIZE = 50
+
+class Transport(object):
+    """
+    Hold the ``requests.Session`` all of Fandjango's requests to Facebook are made with, so that
+    connections are kept alive and shared between them. Each process gets a session of its own.
+    """
+
+    usage = 0
+    """An integer describing how much of its rate limit the application had used in percent, as of Facebook's last response."""
+
+    def __init__(self, size):
+        """
+        :param size: An integer describing how many connections to each host to keep open.
+        """
+        self.size = size
+        self.pid = None
+        self.lock = Lock()
+
+    @property
+    def session(self):
+        """A ``requests.Session`` instance."""
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    session = requests.Session()
+
+                    for prefix in ('http://', 'https://'):
+                        session.mount(prefix, HTTPAdapter(pool_maxsize=self.size))
+
+                    session.hooks['response'].append(self.record_usage)
+
+                    self._session = session
+                    self.pid = os.getpid()
+
+        return self._session
+
+    def record_usage(self, response, *args, **kwargs):
+        """Record the usage of the application's rate limit Facebook reports in the ``X-App-Usage`` header."""
+        try:
+            usage = json.loads(response.headers['X-App-Usage'])
+        except (KeyError, ValueError):
+            return
+
+        if isinstance(usage, dict):
+            self.usage = max([value for value in usage.values() if isinstance(value, (int, long, float))] or [0])
+
+    def get_statistics(self):
+        """
+        Return a dictionary mapping each host requests have been made to with a dictionary
+        describing the number of ``requests`` made and the number of ``connections`` opened.
+        """
+        statistics = {}
+
+        if self.pid != os.getpid():
+            return statistics
+
+        for adapter in self._session.adapters.values():
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+
+                if pool is None:
+                    continue
+
+                host = statistics.setdefault('%s://%s:%s' % (pool.scheme, pool.host, pool.port), {
+                    'requests': 0,
+                    'connections': 0
+                })
+                host['requests'] += pool.num_requests
+                host['connections'] += pool.num_connections
+
+        return statistics
+
+transport = Transport(GRAPH_API_POOL_SIZE)
+
+class BatchingGraphAPI(GraphAPI):
+    """
+    A ``GraphAPI`` that defers requests for single objects made while batching (see ``batching``)
+    until the result of one of them is used, and then makes all of them in a single batch request.
+
+    Requests are retried ``FANDJANGO_GRAPH_API_RETRIES`` times unless told otherwise.
+    """
+
+    def __init__(self, oauth_token=False, url=GRAPH_API_URL, timeout=None, session=None):
+        """
+        :param oauth_token: A string describing an OAuth token, or ``False`` to query the Graph API anonymously.
+        :param url: A string describing the URL of the Graph API.
+        :param timeout: A number or tuple describing the timeout of requests, as accepted by ``requests``.
+        :param session: A ``requests.Session`` instance. Defaults to the shared session.
+        """
+        # Facepy's constructor creates a session of its own, which would be discarded for the shared one.
+        self.oauth_token = oauth_token
+        self.url = url.strip('/')
+        self.timeout = timeout
+        self.session = session or transport.session
+        self.verify_ssl_certificate = True
+        self.appsecret = False
+        self.version = None
+
+    def get(self, path='', page=False, retry=None, **options):
+        if retry is None:
+            retry = GRAPH_API_RETRIES
+
+        current_batch = get_current_batch()
+
+        if current_batch is None or page:
+            return super(BatchingGraphAPI, self).get(path, page=page, retry=retry, **options)
+
+        return current_batch.add(self.oauth_token, path, options)
+
+class Batch(object):
+    """
+    Batch instances collect requests of the Graph API to be made in a single batch request.
+    """
+
+    def __init__(self):
+        self.pending = []
+
+    def add(self, oauth_token, path, options):
+        """
+        Add a request for the given path to the batch, returning a ``LazyResult`` instance for its response.
+
+        :param oauth_token: A string describing the OAuth token to make the request with, or ``False``.
+        :param path: A string describing the object in the Graph API.
+        :param options: A dictionary of Graph API parameters.
+        """
+        result = LazyResult(self)
+        self.pending.append((oauth_token, path, options, result))
+        return result
+
+    def flush(self):
+        """Make all pending requests in a single batch request and resolve their results."""
+        pending, self.pending = self.pending, []
+
+        if not pending:
+            return
+
+        try:
+            responses = batch([
+                {'method': 'GET', 'relative_url': get_relative_url(oauth_token, path, options)}
+                for oauth_token, path, options, result in pending
+            ])
+        except Exception as exception:
+            # Results that have been removed from the batch must raise the exception, too,
+            # since they would otherwise never be resolved.
+            for oauth_token, path, options, result in pending:
+                result.resolve(exception)
+
+            raise
+
+        for (oauth_token, path, options, result), response in zip(pending, responses):
+            if response is False:
+                response = FacebookError('Could not get "%s".' % path)
+
+            result.resolve(response)
+
+class LazyResult(object):
+    """
+    LazyResult instances stand in for the response to a request in a batch, and make the batch's
+    pending requests upon being used. Failed requests raise their exception upon being used.
+    """
+
+    def __init__(self, batch):
+        self._batch = batch
+        self._resolved = False
+
+    def resolve(self, response):
+        self._response = response
+        self._resolved = True
+
+    @property
+    def value(self):
+        """The response to the request."""
+        if not self._resolved:
+            self._batch.flush()
+
+        if isinstance(self._response, Exception):
+            raise self._response
+
+        return self._response
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        return getattr(self.value, name)
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __contains__(self, item):
+        return item in self.value
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __nonzero__(self):
+        return bool(self.value)
+
+    def __eq__(self, other):
+        return self.value == other
+
+    def __ne__(self, other):
+        return self.value != other
+
+    def __str__(self):
+        return str(self.value)
+
+    def __unicode__(self):
+        return unicode(self.value)
+
+    def __repr__(self):
+        return repr(self.value)
+
+state = local()
+
+def get_current_batch():
+    """Return the ``Batch`` instance requests made by the current thread are added to, or ``None``."""
+    return getattr(state, 'batch', None)
+
+def begin_batch():
+    """Start collecting requests of the Graph API made by the current thread into a new batch."""
+    state.batch = Batch()
+
+def end_batch():
+    """Stop collecting requests into a batch. Requests already collected are made once their results are used."""
+    state.batch = None
+
+@contextmanager
+def batching():
+    """
+    Collect requests of single objects from the Graph API made within the block, and make them in a single
+    batch request once the result of one of them is used::
+
+        with batching():
+            profile = user.graph.get('me')
+            friends = user.graph.get('me/friends')
+
+        profile['name']
+
+    Nested blocks join the outermost batch.
+    """
+    if get_current_batch() is not None:
+        yield get_current_batch()
+        return
+
+    begin_batch()
+
+    try:
+        yield get_current_batch()
+    finally:
+        end_batch()
+
+def get_relative_url(oauth_token, path, options):
+    """Return the URL of a request of the given path relative to the Graph API, as used in batch requests."""
+    parameters = []
+
+    for key, value in sorted(options.items()):
+        if isinstance(value, (list, set, tuple)):
+            value = ','.join(value)
+
+        parameters.append((key, value))
+
+    if oauth_token:
+        parameters.append(('access_token', oauth_token))
+
+    if not parameters:
+        return path.strip('/')
+
+    return '%s?%s' % (path.strip('/'), urlencode(parameters))
+
+def get_timeout():
+    """Return the timeout of requests to Facebook, as accepted by ``requests``."""
+    if GRAPH_API_CONNECT_TIMEOUT is None:
+        return GRAPH_API_TIMEOUT
+
+    return (GRAPH_API_CONNECT_TIMEOUT, GRAPH_API_TIMEOUT)
+
+def get_graph_api(oauth_token=False):
+    """
+    Return a ``GraphAPI`` instance that queries ``FANDJANGO_GRAPH_API_URL`` over the shared connection
+    pool and gives up on requests that take longer than ``FANDJANGO_GRAPH_API_TIMEOUT`` seconds,
+    retrying them ``FANDJANGO_GRAPH_API_RETRIES`` times.
+    Its requests are batched while batching (see ``batching``).
+
+    :param oauth_token: A string describing an OAuth token, or ``False`` to query the Graph API anonymously.
+    """
+    return BatchingGraphAPI(oauth_token, url=GRAPH_API_URL, timeout=get_timeout(), session=transport.session)
+
+def get_application_access_token():
+    """Return a string describing the application's access token."""
+    return '%s|%s' % (FACEBOOK_APPLICATION_ID, FACEBOOK_APPLICATION_SECRET_KEY)
+
+def batch(requests, oauth_token=None, concurrency=None):
+    """
+    Make the given requests of the Graph API in batches of 50, making up to ``FANDJANGO_GRAPH_API_CONCURRENCY``
+    batch requests concurrently.
+
+    Returns a list of responses in the order of the given requests, with the exception raised
+    in place of the response to each request that failed.
+
+    :param requests: A list of dictionaries with keys 'method', 'relative_url' and optionally 'body'.
+    :param oauth_token: A string describing an OAuth token. Defaults to the application's access token.
+    :param concurrency: An integer describing how many batch requests to make concurrently.
+                        Defaults to ``FANDJANGO_GRAPH_API_CONCURRENCY``.
+    """
+    oauth_token = oauth_token or get_application_access_token()
+    concurrency = concurrency or GRAPH_API_CONCURRENCY
+
+    chunks = [requests[i:i + BATCH_SIZE] for i in range(0, len(requests), BATCH_SIZE)]
+
+    def query(chunk):
+        return list(get_graph_api(oauth_token).batch(chunk))
+
+    if len(chunks) > 1 and concurrency > 1:
+        pool = ThreadPool(min(len(chunks), concurrency))
+
+        try:
+            responses = pool.map(query, chunks)
+        finally:
+            pool.close()
+    else:
+        responses = map(query, chunks)
+
+    return [response for chunk in responses for response in chunk]
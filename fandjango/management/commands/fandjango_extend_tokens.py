@@ -0,0 +1,167 @@
+import json
+import time
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+from threading import Lock
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.db.models.signals import post_save
+
+from facepy import FacebookError
+
+from fandjango.models import OAuthToken, get_token_digest, invalidate_cached_oauth_token
+from fandjango.graph import transport
+from fandjango.tasks import is_extension_backed_off, record_extension_failure, get_extension_backoff_cache_key
+
+try:
+    from django.utils.timezone import now
+except ImportError:
+    from datetime import datetime
+    def now():
+        return datetime.now()
+
+# Codes of errors Facebook responds with when the application exceeds its rate limit.
+RATE_LIMIT_ERROR_CODES = (4, 17, 32, 613)
+
+class Command(BaseCommand):
+    help = 'Extend OAuth tokens that expire soon.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--window', type='int', dest='window', default=7 * 86400,
+            help='Extend OAuth tokens that expire within this many seconds [default: %default].'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=100,
+            help='Number of OAuth tokens to read from the database at a time [default: %default].'),
+        make_option('--workers', type='int', dest='workers', default=4,
+            help='Number of OAuth tokens to extend concurrently [default: %default].'),
+        make_option('--max-usage', type='int', dest='max_usage', default=75,
+            help='Pause once Facebook reports this much of the rate limit has been used, in percent [default: %default].'),
+        make_option('--pause', type='int', dest='pause', default=60,
+            help='Number of seconds to pause for once the rate limit is near [default: %default].'),
+        make_option('--outcomes', dest='outcomes', default=None,
+            help='File to append the outcome of each attempt to extend an OAuth token to, as lines of JSON.'),
+    )
+
+    def handle(self, *args, **options):
+        self.max_usage = options['max_usage']
+        self.pause = options['pause']
+        self.verbosity = int(options['verbosity'])
+        self.lock = Lock()
+
+        if options['chunk_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--chunk-size and --workers must be positive.')
+
+        oauth_tokens = OAuthToken.objects.filter(
+            expires_at__gt = now(),
+            expires_at__lte = now() + timedelta(seconds=options['window']),
+            user__authorized = True
+        ).order_by('expires_at', 'pk')
+
+        outcomes = open(options['outcomes'], 'a') if options['outcomes'] else None
+        pool = ThreadPool(options['workers'])
+        counts = {}
+        last = None
+
+        try:
+            while True:
+                chunk = oauth_tokens
+
+                if last:
+                    chunk = chunk.filter(Q(expires_at__gt=last[0]) | Q(expires_at=last[0], pk__gt=last[1]))
+
+                chunk = list(chunk[:options['chunk_size']])
+
+                if not chunk:
+                    break
+
+                last = chunk[-1].expires_at, chunk[-1].pk
+
+                for oauth_token, (outcome, extension) in zip(chunk, pool.map(self.extend, chunk)):
+                    if extension:
+                        self.save(oauth_token, *extension)
+                    elif outcome['outcome'] == 'failed':
+                        outcome['attempts'] = record_extension_failure(oauth_token)
+
+                    counts[outcome['outcome']] = counts.get(outcome['outcome'], 0) + 1
+
+                    if outcomes:
+                        outcomes.write(json.dumps(outcome) + '\n')
+
+                    if self.verbosity > 1:
+                        self.stdout.write('OAuth token %(id)s: %(outcome)s' % outcome)
+        finally:
+            pool.close()
+
+            if outcomes:
+                outcomes.close()
+
+        self.stdout.write('Extended %d OAuth tokens (%d failed, %d backed off, %d throttled)' % (
+            counts.get('extended', 0), counts.get('failed', 0), counts.get('backed off', 0), counts.get('throttled', 0)
+        ))
+
+    def extend(self, oauth_token):
+        """
+        Exchange the given OAuth token for a long-lived one, returning a tuple of a dictionary describing
+        the outcome and a tuple of the new token and when it expires (or ``None`` if it wasn't extended).
+
+        Runs in the worker threads, which leave saving the new token to the main thread so that they
+        don't need database connections of their own.
+        """
+        outcome = {'id': oauth_token.pk, 'at': time.time()}
+
+        if is_extension_backed_off(oauth_token):
+            outcome['outcome'] = 'backed off'
+            return outcome, None
+
+        self.throttle()
+
+        try:
+            token, expires_at = oauth_token.exchange()
+        except Exception as exception:
+            if isinstance(exception, FacebookError) and exception.code in RATE_LIMIT_ERROR_CODES:
+                transport.usage = 100
+                outcome['outcome'] = 'throttled'
+            else:
+                outcome['outcome'] = 'failed'
+
+            outcome['error'] = unicode(exception)
+
+            return outcome, None
+
+        outcome['outcome'] = 'extended'
+        outcome['expires_at'] = expires_at.isoformat()
+
+        return outcome, (token, expires_at)
+
+    def save(self, oauth_token, token, expires_at):
+        """
+        Save the given extension of the given OAuth token, unless the token has been replaced
+        (e.g. by its owner authorizing the application anew) since it was read.
+        """
+        updated = OAuthToken.objects.filter(pk=oauth_token.pk, token=oauth_token.token).update(
+            token = token,
+            token_digest = get_token_digest(token),
+            expires_at = expires_at
+        )
+
+        if updated:
+            oauth_token.token, oauth_token.expires_at = token, expires_at
+            invalidate_cached_oauth_token(OAuthToken, oauth_token, signal=post_save)
+
+        cache.delete(get_extension_backoff_cache_key(oauth_token))
+
+    def throttle(self):
+        """Pause while Facebook reports the application is close to its rate limit."""
+        with self.lock:
+            if transport.usage >= self.max_usage:
+                if self.verbosity > 0:
+                    self.stdout.write('Facebook reports %d%% of the rate limit has been used; pausing for %d seconds' % (
+                        transport.usage, self.pause
+                    ))
+
+                time.sleep(self.pause)
+
+                # The next response reports the current usage.
+                transport.usage = 0
@@ -0,0 +1,86 @@
+import time
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+from django.db.models import Q, sql
+
+from fandjango.models import User, OAuthToken, get_oauth_token_cache_key
+
+try:
+    from django.utils.timezone import now
+except ImportError:
+    from datetime import datetime
+    def now():
+        return datetime.now()
+
+class Command(BaseCommand):
+    help = 'Delete OAuth tokens that no user references and that have expired or been abandoned.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help='Number of OAuth tokens to delete at a time [default: %default].'),
+        make_option('--pause', type='float', dest='pause', default=0.5,
+            help='Number of seconds to pause for between batches [default: %default].'),
+        make_option('--grace', type='int', dest='grace', default=86400,
+            help='Delete OAuth tokens that have not expired once they were issued this many seconds ago [default: %default].'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        pause = options['pause']
+        verbosity = int(options['verbosity'])
+
+        if batch_size < 1 or pause < 0 or options['grace'] < 0:
+            raise CommandError('--batch-size must be positive, and --pause and --grace must not be negative.')
+
+        # Tokens are only deleted while no user references them, since deleting them would delete the
+        # user, too. Tokens that haven't expired are given a grace period so that users may be registered
+        # with tokens that have been created for them.
+        self.reapable = Q(expires_at__lte=now()) | Q(issued_at__lte=now() - timedelta(seconds=options['grace']))
+
+        oauth_tokens = OAuthToken.objects.filter(self.reapable, user__isnull=True).order_by('pk')
+
+        last_pk = 0
+        deleted = 0
+
+        while True:
+            chunk = list(oauth_tokens.filter(pk__gt=last_pk).values_list('pk', 'token')[:batch_size])
+
+            if not chunk:
+                break
+
+            last_pk = chunk[-1][0]
+            deleted += self.delete(chunk)
+
+            if verbosity > 1:
+                self.stdout.write('Deleted %d OAuth tokens up to #%d' % (deleted, last_pk))
+
+            time.sleep(pause)
+
+        self.stdout.write('Deleted %d OAuth tokens' % deleted)
+
+    def delete(self, oauth_tokens):
+        """
+        Delete the given OAuth tokens in a transaction of their own, unless they have been claimed by a user since
+        they were read, and return the number of OAuth tokens that were deleted.
+
+        :param oauth_tokens: A list of tuples of the primary key and token of each OAuth token.
+        """
+        using = router.db_for_write(OAuthToken)
+
+        # Delete the tokens in a single statement of their own rather than through ``QuerySet.delete``,
+        # which would delete any user that has been given one of them since they were read.
+        query = OAuthToken.objects.filter(self.reapable, pk__in=[pk for pk, token in oauth_tokens]).exclude(
+            pk__in = User.objects.values('oauth_token')
+        ).query.clone(klass=sql.DeleteQuery)
+        query.get_initial_alias()
+
+        with transaction.commit_on_success(using=using):
+            deleted = query.get_compiler(using).execute_sql(None).rowcount
+
+        cache.delete_many([get_oauth_token_cache_key(token) for pk, token in oauth_tokens])
+
+        return deleted
@@ -0,0 +1,168 @@
+import os
+import time
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+
+from fandjango.models import User, get_user_cache_key
+from fandjango.graph import batch, get_relative_url
+from fandjango.settings import GRAPH_API_CONCURRENCY
+from fandjango.utils import bulk_update
+
+try:
+    from django.utils.timezone import now
+except ImportError:
+    from datetime import datetime
+    def now():
+        return datetime.now()
+
+class Command(BaseCommand):
+    help = 'Synchronize the profiles of users that have not been synchronized recently with Facebook.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--older-than', type='int', dest='older_than', default=7 * 86400,
+            help='Synchronize users that have not been synchronized for this many seconds [default: %default].'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+            help='Number of users to read from the database at a time [default: %default].'),
+        make_option('--concurrency', type='int', dest='concurrency', default=GRAPH_API_CONCURRENCY,
+            help='Number of batch requests to make of the Graph API concurrently [default: %default].'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+            help='File to record progress in, and resume from if it exists.'),
+        make_option('--backoff', type='int', dest='backoff', default=86400,
+            help='Number of seconds to wait before synchronizing a user that could not be synchronized again, '
+                 'doubling with every consecutive failure [default: %default].'),
+    )
+
+    def handle(self, *args, **options):
+        older_than = options['older_than']
+        chunk_size = options['chunk_size']
+        concurrency = options['concurrency']
+        checkpoint = options['checkpoint']
+        self.backoff = options['backoff']
+
+        if chunk_size < 1 or concurrency < 1:
+            raise CommandError('--chunk-size and --concurrency must be positive.')
+
+        last_pk = self.read_checkpoint(checkpoint)
+
+        # Load ``extra_data`` to tell whether it has changed
+        users = User.objects.defer(None).select_related('oauth_token').filter(
+            Q(synchronized_at__isnull=True) | Q(synchronized_at__lt=now() - timedelta(seconds=older_than)),
+            Q(oauth_token__expires_at__isnull=True) | Q(oauth_token__expires_at__gt=now()),
+            authorized = True
+        ).order_by('pk')
+
+        synchronized = failed = backed_off = 0
+
+        while True:
+            chunk = list(users.filter(pk__gt=last_pk)[:chunk_size])
+
+            if not chunk:
+                break
+
+            succeeded, unsucceeded, skipped = self.synchronize(chunk, concurrency)
+
+            synchronized += succeeded
+            failed += unsucceeded
+            backed_off += skipped
+            last_pk = chunk[-1].pk
+
+            self.write_checkpoint(checkpoint, last_pk)
+
+            if int(options['verbosity']) > 1:
+                self.stdout.write('Synchronized %d users up to #%d' % (synchronized, last_pk))
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        self.stdout.write('Synchronized %d users (%d failed, %d backed off)' % (synchronized, failed, backed_off))
+
+    def synchronize(self, users, concurrency):
+        """
+        Synchronize the given users with Facebook in batch requests, writing the details that changed
+        in bulk. Users that could not be synchronized recently are skipped.
+
+        Returns a tuple of the number of users that were synchronized, the number that could not be
+        and the number that were skipped.
+        """
+        backoffs = cache.get_many([get_backoff_cache_key(user) for user in users])
+
+        skipped = [user for user in users if backoffs.get(get_backoff_cache_key(user), {}).get('retry_at', 0) > time.time()]
+        users = [user for user in users if user not in skipped]
+
+        responses = batch([
+            {'method': 'GET', 'relative_url': get_relative_url(user.oauth_token.token, 'me', {})}
+            for user in users
+        ], concurrency=concurrency)
+
+        synchronized_users = []
+        failed_users = []
+        changed_fields = {}
+
+        for user, response in zip(users, responses):
+            if not isinstance(response, dict):
+                failed_users.append(user)
+                continue
+
+            user.apply_profile(response)
+
+            for name in user.changed_fields:
+                changed_fields.setdefault(name, []).append(user)
+
+            synchronized_users.append(user)
+
+        with transaction.commit_on_success():
+            bulk_update(synchronized_users, changed_fields)
+
+            User.objects.filter(pk__in=[user.pk for user in synchronized_users]).update(synchronized_at=now())
+
+        cache.delete_many(
+            [get_user_cache_key(user.facebook_id) for user in synchronized_users] +
+            [get_backoff_cache_key(user) for user in synchronized_users if get_backoff_cache_key(user) in backoffs]
+        )
+
+        self.record_failures(failed_users, backoffs)
+
+        return len(synchronized_users), len(failed_users), len(skipped)
+
+    def record_failures(self, users, backoffs):
+        """
+        Record that the given users could not be synchronized, and back off from synchronizing them
+        again for ``--backoff`` seconds, doubling with every consecutive failure.
+
+        :param users: A list of ``User`` instances.
+        :param backoffs: A dictionary mapping backoff cache keys to the backoffs recorded so far.
+        """
+        for user in users:
+            key = get_backoff_cache_key(user)
+
+            attempts = backoffs.get(key, {}).get('attempts', 0) + 1
+            delay = min(self.backoff * 2 ** (attempts - 1), 86400 * 30)
+
+            cache.set(key, {'attempts': attempts, 'retry_at': time.time() + delay}, delay * 2)
+
+    def read_checkpoint(self, checkpoint):
+        """Return the primary key of the last user that was synchronized as of the given checkpoint file, or ``0``."""
+        if not checkpoint or not os.path.exists(checkpoint):
+            return 0
+
+        with open(checkpoint) as f:
+            return int(f.read().strip() or 0)
+
+    def write_checkpoint(self, checkpoint, pk):
+        """Record the primary key of the last user that was synchronized in the given checkpoint file."""
+        if not checkpoint:
+            return
+
+        with open('%s.tmp' % checkpoint, 'w') as f:
+            f.write(str(pk))
+
+        os.rename('%s.tmp' % checkpoint, checkpoint)
+
+def get_backoff_cache_key(user):
+    """Return the key failed attempts to synchronize the given user are recorded under."""
+    return 'fandjango.User.synchronization_backoff_%s' % user.pk
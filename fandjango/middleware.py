@@ -3,17 +3,22 @@ from django.http import QueryDict, HttpResponseRedirect
 from datetime import timedelta
 from urlparse import parse_qs
 
-from django.core.exceptions import ImproperlyConfigured
-
 from fandjango.views import authorize_application, authorization_denied
-from fandjango.models import Facebook, User, OAuthToken
+from fandjango.models import Facebook, LazyFacebook, User, OAuthToken, get_token_digest
+from fandjango.tracking import last_seen
+from fandjango.tasks import extend_oauth_token, synchronize_user
+from fandjango.graph import get_graph_api, get_current_batch, begin_batch, end_batch
+from fandjango.timing import get_timing
+from fandjango.signals import request_timed
 from fandjango.settings import (
     FACEBOOK_APPLICATION_SECRET_KEY, FACEBOOK_APPLICATION_ID,
-    FANDJANGO_CACHE_SIGNED_REQUEST, DISABLED_PATHS, ENABLED_PATHS
+    FANDJANGO_CACHE_SIGNED_REQUEST, DISABLED_PATHS, ENABLED_PATHS, LAZY_USER,
+    SERVER_TIMING_HEADER, GRAPH_API_BATCHING, EXTEND_OAUTH_TOKENS_ON_REQUEST
 )
 from fandjango.utils import (
     is_disabled_path, is_enabled_path, get_full_path,
-    authorization_denied_view, get_post_authorization_redirect_url
+    authorization_denied_view, get_post_authorization_redirect_url,
+    parse_signed_request, is_equivalent_signed_request
 )
 
 from facepy import SignedRequest, GraphAPI
@@ -30,12 +35,6 @@ from dateutil.tz import tzlocal
 class BaseMiddleware():
 
     def is_valid_path(self, request):
-        if ENABLED_PATHS and DISABLED_PATHS:
-            raise ImproperlyConfigured(
-                'You may configure either FANDJANGO_ENABLED_PATHS '
-                'or FANDJANGO_DISABLED_PATHS, but not both.'
-            )
-
         if DISABLED_PATHS and is_disabled_path(request.path):
             return False
 
@@ -47,6 +46,42 @@ class BaseMiddleware():
     def is_access_denied(self, request):
         return 'error' in request.GET and request.GET['error'] == 'access_denied'
 
+    def update_last_seen(self, user, save=False):
+        """
+        Update the user's ``last_seen_at``, buffering the write if ``FANDJANGO_LAST_SEEN_RESOLUTION``
+        is configured and the user has no other changes to save.
+        """
+        if last_seen and not save:
+            last_seen.touch(user)
+        else:
+            user.last_seen_at = now()
+            user.save()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """Batch requests of the Graph API made by the view if ``FANDJANGO_GRAPH_API_BATCHING`` is enabled."""
+        if GRAPH_API_BATCHING and getattr(request, 'facebook', None) and get_current_batch() is None:
+            begin_batch()
+
+    def report_timing(self, request, response):
+        """
+        Send the ``request_timed`` signal with the timing of the given request and add it to the
+        response's ``Server-Timing`` header if ``FANDJANGO_SERVER_TIMING_HEADER`` is enabled.
+        """
+        timing = getattr(request, 'fandjango_timing', None)
+
+        if timing is None or timing.reported:
+            return
+
+        timing.reported = True
+
+        if SERVER_TIMING_HEADER and timing.durations:
+            if response.has_header('Server-Timing'):
+                response['Server-Timing'] = '%s, %s' % (response['Server-Timing'], timing.header())
+            else:
+                response['Server-Timing'] = timing.header()
+
+        request_timed.send(sender=self.__class__, request=request, timing=timing)
+
 class FacebookMiddleware(BaseMiddleware):
     """Middleware for Facebook canvas applications."""
 
@@ -82,12 +117,13 @@ class FacebookMiddleware(BaseMiddleware):
             request.method = 'GET'
 
         request.facebook = Facebook()
+        timing = get_timing(request)
 
         try:
-            request.facebook.signed_request = SignedRequest(
-                signed_request = request.REQUEST.get('signed_request') or request.COOKIES.get('signed_request'),
-                application_secret_key = FACEBOOK_APPLICATION_SECRET_KEY
-            )
+            with timing.stage('signed_request'):
+                request.facebook.signed_request = parse_signed_request(
+                    request.REQUEST.get('signed_request') or request.COOKIES.get('signed_request')
+                )
         except SignedRequest.Error:
             request.facebook = False
 
@@ -96,49 +132,61 @@ class FacebookMiddleware(BaseMiddleware):
             and request.facebook.signed_request.user.has_authorized_application \
             and not request.facebook.signed_request.user.oauth_token.has_expired:
 
-            # Initialize a User object and its corresponding OAuth token
-            try:
-                user = User.objects.get(facebook_id=request.facebook.signed_request.user.id)
-            except User.DoesNotExist:
-                oauth_token = OAuthToken.objects.create(
-                    token = request.facebook.signed_request.user.oauth_token.token,
-                    issued_at = request.facebook.signed_request.user.oauth_token.issued_at.replace(tzinfo=tzlocal()),
-                    expires_at = request.facebook.signed_request.user.oauth_token.expires_at.replace(tzinfo=tzlocal())
-                )
-
-                user = User.objects.create(
-                    facebook_id = request.facebook.signed_request.user.id,
-                    oauth_token = oauth_token
-                )
+            if LAZY_USER:
+                signed_request = request.facebook.signed_request
 
-                user.synchronize()
+                def get_user():
+                    with timing.stage('user'):
+                        return self.get_user(request, signed_request), None
 
-            # Update the user's details and OAuth token
+                request.facebook = LazyFacebook(get_user)
+                request.facebook.signed_request = signed_request
             else:
-                user.last_seen_at = now()
+                with timing.stage('user'):
+                    request.facebook.user = self.get_user(request, request.facebook.signed_request)
 
-                if 'signed_request' in request.REQUEST:
-                    user.authorized = True
+    def get_user(self, request, signed_request):
+        """
+        Get the user that issued the given signed request, registering him/her if he/she is new.
 
-                    if request.facebook.signed_request.user.oauth_token:
-                        user.oauth_token.token = request.facebook.signed_request.user.oauth_token.token
-                        user.oauth_token.issued_at = request.facebook.signed_request.user.oauth_token.issued_at.replace(tzinfo=tzlocal())
-                        user.oauth_token.expires_at = request.facebook.signed_request.user.oauth_token.expires_at.replace(tzinfo=tzlocal())
-                        user.oauth_token.save()
+        :param request: The ``HttpRequest`` the signed request was issued with.
+        :param signed_request: A ``SignedRequest`` instance.
+        """
+        # Initialize a User object and its corresponding OAuth token
+        try:
+            user = User.objects.get_by_facebook_id(signed_request.user.id)
+        except User.DoesNotExist:
+            user, registered = User.objects.register(
+                facebook_id = signed_request.user.id,
+                token = signed_request.user.oauth_token.token,
+                issued_at = signed_request.user.oauth_token.issued_at.replace(tzinfo=tzlocal()),
+                expires_at = signed_request.user.oauth_token.expires_at.replace(tzinfo=tzlocal())
+            )
 
-                user.save()
+            if registered:
+                synchronize_user(user)
 
-            if not user.oauth_token.extended:
-                # Attempt to extend the OAuth token, but ignore exceptions raised by
-                # bug #102727766518358 in the Facebook Platform.
-                #
-                # http://developers.facebook.com/bugs/102727766518358/
-                try:
-                    user.oauth_token.extend()
-                except:
-                    pass
+        # Update the user's details and OAuth token
+        else:
+            authorized = user.authorized
 
-            request.facebook.user = user
+            if 'signed_request' in request.REQUEST:
+                user.authorized = True
+
+                if signed_request.user.oauth_token \
+                    and signed_request.user.oauth_token.token != user.oauth_token.token:
+                    user.oauth_token.token = signed_request.user.oauth_token.token
+                    user.oauth_token.issued_at = signed_request.user.oauth_token.issued_at.replace(tzinfo=tzlocal())
+                    user.oauth_token.expires_at = signed_request.user.oauth_token.expires_at.replace(tzinfo=tzlocal())
+                    user.oauth_token.save()
+
+            self.update_last_seen(user, save=user.authorized != authorized)
+
+        if EXTEND_OAUTH_TOKENS_ON_REQUEST and not user.oauth_token.extended:
+            with get_timing(request).stage('extend'):
+                extend_oauth_token(user.oauth_token)
+
+        return user
 
     def process_response(self, request, response):
         """
@@ -152,12 +200,36 @@ class FacebookMiddleware(BaseMiddleware):
 
         if FANDJANGO_CACHE_SIGNED_REQUEST:
             if hasattr(request, "facebook") and request.facebook and request.facebook.signed_request:
-                response.set_cookie('signed_request', request.facebook.signed_request.generate())
-            else:
+                with get_timing(request).stage('signed_request'):
+                    if not self.has_signed_request_cookie(request):
+                        response.set_cookie('signed_request', request.facebook.signed_request.generate())
+            elif 'signed_request' in request.COOKIES:
                 response.delete_cookie('signed_request')
-        
+
+        if GRAPH_API_BATCHING:
+            end_batch()
+
+        self.report_timing(request, response)
+
         return response
 
+    def has_signed_request_cookie(self, request):
+        """Determine whether the signed request cookie already carries the current signed request."""
+        cookie = request.COOKIES.get('signed_request')
+
+        if not cookie:
+            return False
+
+        signed_request = request.facebook.signed_request
+
+        if cookie == getattr(signed_request, 'signed_request', None):
+            return True
+
+        try:
+            return is_equivalent_signed_request(signed_request, parse_signed_request(cookie))
+        except (SignedRequest.Error, KeyError):
+            return False
+
 class FacebookWebMiddleware(BaseMiddleware):
     """Middleware for Facebook auth on websites."""
 
@@ -176,35 +248,70 @@ class FacebookWebMiddleware(BaseMiddleware):
         if self.is_access_denied(request):
             return authorization_denied_view(request)
 
-        request.facebook = Facebook()
+        # Defer looking up the OAuth token until the view asks for the user
+        timing = get_timing(request)
+
+        if LAZY_USER and 'oauth_token' in request.COOKIES:
+            def get_user():
+                with timing.stage('user'):
+                    return self.get_user(request)
+
+            request.facebook = LazyFacebook(get_user)
+            return
+
+        with timing.stage('user'):
+            user, oauth_token = self.get_user(request)
+
+        if user:
+            request.facebook = Facebook()
+            request.facebook.user = user
+            request.facebook.oauth_token = oauth_token
+
+    def get_user(self, request):
+        """
+        Get the user that issued the given request and his/her OAuth token from either
+        the OAuth token cookie or an authorization code, registering him/her if he/she is new.
+
+        Returns a tuple of ``(None, None)`` if the request was not issued by an authorized user.
+
+        :param request: An ``HttpRequest`` instance.
+        """
         oauth_token = False
+        new_oauth_token = False
+        user = None
 
         # Is there a token cookie already present?
         if 'oauth_token' in request.COOKIES:
             try:
-                # Check if the current token is already in DB
-                oauth_token = OAuthToken.objects.get(token=request.COOKIES['oauth_token'])
-            except OAuthToken.DoesNotExist:
-                request.facebook = False
-                return
+                # Check if the current token belongs to a user
+                user = User.objects.get_by_oauth_token(request.COOKIES['oauth_token'])
+                oauth_token = user.oauth_token
+            except User.DoesNotExist:
+                try:
+                    # Check if the current token is already in DB
+                    oauth_token = OAuthToken.objects.get_by_token(request.COOKIES['oauth_token'])
+                except OAuthToken.DoesNotExist:
+                    return None, None
 
         # Is there a code in the GET request?
         elif 'code' in request.GET:
             try:
-                graph = GraphAPI()
+                graph = get_graph_api()
 
                 # Exchange code for an access_token
-                response = graph.get('oauth/access_token',
-                    client_id = FACEBOOK_APPLICATION_ID,
-                    redirect_uri = get_post_authorization_redirect_url(request, canvas=False),
-                    client_secret = FACEBOOK_APPLICATION_SECRET_KEY,
-                    code = request.GET['code'],
-                )
+                with get_timing(request).stage('graph'):
+                    response = graph.get('oauth/access_token',
+                        client_id = FACEBOOK_APPLICATION_ID,
+                        redirect_uri = get_post_authorization_redirect_url(request, canvas=False),
+                        client_secret = FACEBOOK_APPLICATION_SECRET_KEY,
+                        code = request.GET['code'],
+                    )
         
                 components = parse_qs(response)
                 
                 # Save new OAuth-token in DB
                 oauth_token, new_oauth_token = OAuthToken.objects.get_or_create(
+                    token_digest = get_token_digest(components['access_token'][0]),
                     token = components['access_token'][0],
                     issued_at = now(),
                     expires_at = now() + timedelta(seconds = int(components['expires'][0]))
@@ -215,20 +322,20 @@ class FacebookWebMiddleware(BaseMiddleware):
         
         # There isn't a valid access_token
         if not oauth_token or oauth_token.expired:
-            request.facebook = False
-            return
+            return None, None
         
         # Is there a user already connected to the current token?
         try:
-            user = oauth_token.user
+            if user is None:
+                user = User.objects.get(oauth_token=oauth_token)
             if not user.authorized:
-                request.facebook = False
-                return
-            user.last_seen_at = now()
-            user.save()
+                return None, None
+            self.update_last_seen(user)
         except User.DoesNotExist:
-            graph = GraphAPI(oauth_token.token)
-            profile = graph.get('me')
+            graph = get_graph_api(oauth_token.token)
+
+            with get_timing(request).stage('graph'):
+                profile = graph.get('me')
             
             # Either the user already exists and its just a new token, or user and token both are new
             try:
@@ -238,14 +345,15 @@ class FacebookWebMiddleware(BaseMiddleware):
                         user.last_seen_at = now()
                         user.authorized = True
                     else:
-                        request.facebook = False
-                        return
+                        return None, None
             except User.DoesNotExist:
-                # Create a new user to go with token
-                user = User.objects.create(
+                # Create a new user to go with token, unless he/she was created concurrently
+                user, created = User.objects.get_or_create(
                     facebook_id = profile.get('id'),
-                    oauth_token = oauth_token
-                )                    
+                    defaults = {
+                        'oauth_token': oauth_token
+                    }
+                )
             
             user.synchronize(profile)
             
@@ -260,18 +368,11 @@ class FacebookWebMiddleware(BaseMiddleware):
             if old_oauth_token:
                 old_oauth_token.delete()
 
-        if not user.oauth_token.extended:
-            # Attempt to extend the OAuth token, but ignore exceptions raised by
-            # bug #102727766518358 in the Facebook Platform.
-            #
-            # http://developers.facebook.com/bugs/102727766518358/
-            try:
-                user.oauth_token.extend()
-            except:
-                pass
+        if EXTEND_OAUTH_TOKENS_ON_REQUEST and not user.oauth_token.extended:
+            with get_timing(request).stage('extend'):
+                extend_oauth_token(user.oauth_token)
 
-        request.facebook.user = user
-        request.facebook.oauth_token = oauth_token
+        return user, oauth_token
 
 
     def process_response(self, request, response):
@@ -282,7 +383,11 @@ class FacebookWebMiddleware(BaseMiddleware):
         browsers it is considered by IE before accepting third-party cookies (ie. cookies set by
         documents in iframes). If they are not set correctly, IE will not set these cookies.
         """
-        if hasattr(request, "facebook") and request.facebook and request.facebook.oauth_token:
+        # The view never asked for the user, so the OAuth token cookie is left as it is.
+        if isinstance(getattr(request, "facebook", None), LazyFacebook) and not request.facebook.evaluated:
+            pass
+
+        elif hasattr(request, "facebook") and request.facebook and request.facebook.oauth_token:
             if "code" in request.REQUEST:
                 """ Remove auth related query params """
                 path = get_full_path(request, remove_querystrings=['code', 'web_canvas'])
@@ -294,4 +399,9 @@ class FacebookWebMiddleware(BaseMiddleware):
 
         response['P3P'] = 'CP="IDC CURa ADMa OUR IND PHY ONL COM STA"'
 
+        if GRAPH_API_BATCHING:
+            end_batch()
+
+        self.report_timing(request, response)
+
         return response
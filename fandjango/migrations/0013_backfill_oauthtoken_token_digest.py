@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import datetime
+import hashlib
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+from fandjango.migrations import create_index
+
+class Migration(DataMigration):
+
+    # The number of tokens to update per transaction, each of which takes three parameters
+    # of a statement (of which SQLite allows 999).
+    CHUNK_SIZE = 300
+
+    def forwards(self, orm):
+        "Compute the digest of existing tokens in chunks, committing after each, and index them."
+        last_pk = 0
+
+        while True:
+            tokens = list(
+                orm.OAuthToken.objects.filter(pk__gt=last_pk)
+                    .order_by('pk')
+                    .values_list('pk', 'token')[:self.CHUNK_SIZE]
+            )
+
+            if not tokens:
+                break
+
+            db.execute(
+                'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                    db.quote_name('fandjango_oauthtoken'),
+                    db.quote_name('token_digest'),
+                    db.quote_name('id'),
+                    ' '.join(['WHEN %s THEN %s'] * len(tokens)),
+                    db.quote_name('id'),
+                    ', '.join(['%s'] * len(tokens))
+                ),
+                [value for pk, token in tokens for value in (pk, hashlib.sha1(token.encode('utf-8')).hexdigest())] +
+                [pk for pk, token in tokens]
+            )
+
+            last_pk = tokens[-1][0]
+
+            db.commit_transaction()
+            db.start_transaction()
+
+        create_index(u'fandjango_oauthtoken', ['token_digest'])
+
+    def backwards(self, orm):
+        "Digests are removed along with their column."
+        db.delete_index(u'fandjango_oauthtoken', ['token_digest'])
+
+    models = {
+        u'fandjango.oauthtoken': {
+            'Meta': {'object_name': 'OAuthToken'},
+            'expires_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'issued_at': ('django.db.models.fields.DateTimeField', [], {}),
+            'token': ('django.db.models.fields.TextField', [], {}),
+            'token_digest': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '40', 'null': 'True', 'blank': 'True'})
+        },
+        u'fandjango.user': {
+            'Meta': {'object_name': 'User'},
+            'authorized': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'birthday': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'email': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'extra_data': ('jsonfield.fields.JSONField', [], {'default': '{}'}),
+            'facebook_id': ('django.db.models.fields.BigIntegerField', [], {'unique': 'True'}),
+            'facebook_username': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'gender': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'last_seen_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'locale': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'middle_name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'oauth_token': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['fandjango.OAuthToken']", 'unique': 'True'}),
+            'synchronized_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['fandjango']
+    symmetrical = True
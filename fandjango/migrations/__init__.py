@@ -0,0 +1,29 @@
+from south.db import db
+
+def create_index(table_name, column_names):
+    """
+    Create an index on the given columns of the given table. On PostgreSQL, the index is built
+    concurrently so that the table may be written to while it's built.
+    """
+    if db.backend_name != 'postgres' or db.dry_run:
+        return db.create_index(table_name, column_names)
+
+    name = db.quote_name(db.create_index_name(table_name, column_names))
+    sql = db.create_index_sql(table_name, column_names).replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1)
+
+    # PostgreSQL can't build indexes concurrently in a transaction, so build it between the
+    # transaction the migration runs in and a new one.
+    db.commit_transaction()
+
+    connection = db._get_connection()
+    cursor = connection.cursor()
+    isolation_level = connection.connection.isolation_level
+    connection.connection.set_isolation_level(0)
+
+    try:
+        # A build that was interrupted leaves an invalid index behind.
+        cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
+        cursor.execute(sql)
+    finally:
+        connection.connection.set_isolation_level(isolation_level)
+        db.start_transaction()
@@ -1,17 +1,24 @@
 from httplib import HTTPConnection
 from datetime import datetime, timedelta
 from urlparse import parse_qs
-
-from django.db import models
+from copy import deepcopy
+import hashlib
+
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import post_save, post_delete, class_prepared
+from django.db.models import Q
+from django.db.models.query_utils import DeferredAttribute
+from django.core.cache import cache
+from django.utils.encoding import force_bytes
 import jsonfield
+import requests
 from django.utils.translation import ugettext as _
 
-from fandjango.utils import cached_property as cached
+from fandjango.utils import cached_property as cached, get_cached_properties, set_cached_properties
 from fandjango.settings import FACEBOOK_APPLICATION_ID, FACEBOOK_APPLICATION_SECRET_KEY
+from fandjango.settings import USER_CACHE_TIMEOUT, GRAPH_API_URL, PERMISSIONS_TIMEOUT
+from fandjango.graph import get_graph_api, get_timeout, batch, transport
 
-from facepy import GraphAPI
-
-import requests
 
 try:
     from django.utils.timezone import now
@@ -19,6 +26,9 @@ except ImportError:
     def now():
         return datetime.now()
 
+# The number of seconds to cache the URLs of users' profile pictures for.
+PICTURE_CACHE_TIMEOUT = 30 * 86400
+
 class Facebook:
     """
     Facebook instances hold information on the current user and
@@ -34,7 +44,287 @@ class Facebook:
     oauth_token = None
     """A ``OAuthToken`` instance."""
 
-class User(models.Model):
+class LazyFacebook(Facebook, object):
+    """
+    LazyFacebook instances defer looking up the current user and
+    his/her OAuth token until either is first accessed.
+    """
+
+    evaluated = False
+    """A boolean describing whether the user and OAuth token have been looked up."""
+
+    def __init__(self, function):
+        """
+        Initialize a lazy Facebook instance.
+
+        :param function: A callable returning a tuple of the user and his/her OAuth token.
+        """
+        self.function = function
+
+    def evaluate(self):
+        """Look up the user and his/her OAuth token unless they have been looked up already."""
+        if not self.evaluated:
+            self.evaluated = True
+            self._user, self._oauth_token = self.function()
+
+    def _get_user(self):
+        self.evaluate()
+        return self._user
+
+    def _set_user(self, user):
+        self.evaluate()
+        self._user = user
+
+    def _get_oauth_token(self):
+        self.evaluate()
+        return self._oauth_token
+
+    def _set_oauth_token(self, oauth_token):
+        self.evaluate()
+        self._oauth_token = oauth_token
+
+    user = property(_get_user, _set_user)
+
+    oauth_token = property(_get_oauth_token, _set_oauth_token)
+
+class ChangeTrackingDeferredAttribute(DeferredAttribute):
+    """
+    ChangeTrackingDeferredAttribute instances remember the value of a deferred field as
+    it was loaded from the database, so that reading it doesn't count as changing it.
+    """
+
+    def __get__(self, instance, owner):
+        loading = instance is not None and self.field_name not in instance.__dict__
+
+        value = super(ChangeTrackingDeferredAttribute, self).__get__(instance, owner)
+
+        if loading:
+            instance._values[self.field_name] = deepcopy(value)
+
+        return value
+
+class ChangeTrackingModel(models.Model):
+    """
+    ChangeTrackingModel instances remember the values of their fields as they were
+    loaded from the database, and only write fields that have changed upon saving.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ChangeTrackingModel, self).__init__(*args, **kwargs)
+        self._remember_values()
+
+    @property
+    def changed_fields(self):
+        """A list of strings describing the fields that have changed since the instance was loaded or saved."""
+        return [
+            field.name for field in self._meta.fields
+            if not field.primary_key
+            and field.attname in self.__dict__
+            and (field.attname not in self._values or self._values[field.attname] != self.__dict__[field.attname])
+        ]
+
+    def save(self, *args, **kwargs):
+        """Save the instance, writing only the fields that have changed unless ``update_fields`` is given."""
+        if not self._state.adding and not args and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = self.changed_fields
+
+        super(ChangeTrackingModel, self).save(*args, **kwargs)
+
+        self._remember_values(kwargs.get('update_fields'))
+
+    def _remember_values(self, fields=None):
+        # Deferred fields are not in the instance dictionary until they are loaded, which remembers
+        # their values (see ``ChangeTrackingDeferredAttribute``), or assigned to.
+        values = dict(
+            (field.attname, deepcopy(self.__dict__[field.attname]))
+            for field in self._meta.fields if field.attname in self.__dict__
+            and (fields is None or field.name in fields or field.attname in fields)
+        )
+
+        if fields is None:
+            self._values = values
+        else:
+            self._values.update(values)
+
+    def _load_deferred_values(self):
+        """Load the values of deferred fields from the database, and remember them as loaded."""
+        fields = [field.attname for field in self._meta.fields if field.attname not in self.__dict__]
+
+        if fields:
+            instance = self._meta.concrete_model._base_manager.using(self._state.db).only(*fields).get(pk=self.pk)
+
+            for attname in fields:
+                self.__dict__[attname] = getattr(instance, attname)
+
+            self._remember_values(fields)
+
+    class Meta:
+        abstract = True
+
+def track_deferred_values(sender, **kwargs):
+    """Remember the values of deferred fields of change-tracking models as they are loaded."""
+    if getattr(sender, '_deferred', False) and issubclass(sender, ChangeTrackingModel):
+        for name, attribute in sender.__dict__.items():
+            if type(attribute) is DeferredAttribute:
+                setattr(sender, name, ChangeTrackingDeferredAttribute(attribute.field_name, sender))
+
+class_prepared.connect(track_deferred_values)
+
+class UserManager(models.Manager):
+
+    def get_query_set(self):
+        """Defer loading ``extra_data``, which may be large and is seldom used, until it's accessed."""
+        return super(UserManager, self).get_query_set().defer('extra_data')
+
+    def get_by_facebook_id(self, facebook_id):
+        """
+        Get the user with the given Facebook ID along with his/her OAuth token,
+        reading from the cache first if ``FANDJANGO_USER_CACHE_TIMEOUT`` is set.
+
+        :param facebook_id: An integer describing the user's Facebook ID.
+        """
+        if USER_CACHE_TIMEOUT is not None:
+            user = cache.get(get_user_cache_key(facebook_id))
+
+            if user is not None:
+                return user
+
+        user = self.select_related('oauth_token').get(facebook_id=facebook_id)
+
+        self.cache(user)
+
+        return user
+
+    def get_by_oauth_token(self, token):
+        """
+        Get the user the given OAuth token belongs to along with the token itself,
+        reading from the cache first if ``FANDJANGO_USER_CACHE_TIMEOUT`` is set.
+
+        :param token: A string describing an OAuth token.
+        """
+        if USER_CACHE_TIMEOUT is not None:
+            facebook_id = cache.get(get_oauth_token_cache_key(token))
+
+            if facebook_id is not None:
+                user = cache.get(get_user_cache_key(facebook_id))
+
+                # The token may have been replaced since it was cached.
+                if user is not None and user.oauth_token.token == token:
+                    return user
+
+        user = self.select_related('oauth_token').get(get_token_query(token, 'oauth_token__'))
+
+        self.cache(user)
+
+        return user
+
+    def register(self, facebook_id, token, issued_at, expires_at):
+        """
+        Register a new user and his/her OAuth token in a single transaction or, if a user
+        with the given Facebook ID has been registered concurrently, update his/her OAuth token.
+
+        Returns a tuple of the user and a boolean describing whether he/she was registered.
+
+        :param facebook_id: An integer describing the user's Facebook ID.
+        :param token: A string describing the user's OAuth token.
+        :param issued_at: A ``datetime`` object describing when the OAuth token was issued.
+        :param expires_at: A ``datetime`` object describing when the OAuth token expires.
+        """
+        with transaction.commit_on_success(using=self.db):
+            sid = transaction.savepoint(using=self.db)
+
+            try:
+                user = self.create(
+                    facebook_id = facebook_id,
+                    oauth_token = OAuthToken.objects.create(
+                        token = token,
+                        issued_at = issued_at,
+                        expires_at = expires_at
+                    )
+                )
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, using=self.db)
+            else:
+                transaction.savepoint_commit(sid, using=self.db)
+                return user, True
+
+            user = self.select_related('oauth_token').get(facebook_id=facebook_id)
+
+            if user.oauth_token.token != token:
+                user.oauth_token.token = token
+                user.oauth_token.issued_at = issued_at
+                user.oauth_token.expires_at = expires_at
+                user.oauth_token.save()
+
+            return user, False
+
+    def resolve_pictures(self, users):
+        """
+        Resolve the profile pictures of the given users in batched Graph API requests, saving them to
+        ``picture_url`` and caching them so that their ``picture`` doesn't have to query Facebook.
+
+        Pictures that have been cached or saved recently are not resolved again. Users whose saved pictures
+        are out of date but could not be resolved again keep them.
+
+        Returns a dictionary mapping the Facebook ID of each user whose picture could be resolved
+        to a string describing the URL to it.
+
+        :param users: A list or queryset of ``User`` instances.
+        """
+        users = list(users)
+        cached_pictures = get_cached_properties(users, 'picture')
+
+        pictures = {}
+        unresolved_users = []
+
+        for user in users:
+            picture = cached_pictures.get(user.pk) or (not user.picture_expired and user.picture_url)
+
+            if picture:
+                pictures[user.facebook_id] = picture
+            else:
+                unresolved_users.append(user)
+
+        if unresolved_users:
+            responses = batch([
+                {'method': 'GET', 'relative_url': '%s/picture?redirect=false' % user.facebook_id}
+                for user in unresolved_users
+            ])
+
+            with transaction.commit_on_success(using=self.db):
+                for user, response in zip(unresolved_users, responses):
+                    if not isinstance(response, dict) or 'data' not in response:
+                        continue
+
+                    user.picture_url = response['data']['url']
+                    user.picture_resolved_at = now()
+                    user.save(update_fields=['picture_url', 'picture_resolved_at'])
+
+                    pictures[user.facebook_id] = user.picture_url
+
+        set_cached_properties('picture', dict(
+            (user, pictures[user.facebook_id]) for user in users if user.facebook_id in pictures
+        ), seconds=PICTURE_CACHE_TIMEOUT)
+
+        for user in unresolved_users:
+            if user.facebook_id not in pictures and user.picture_url:
+                pictures[user.facebook_id] = user.picture_url
+
+        return pictures
+
+    def cache(self, user):
+        """
+        Cache the given user and his/her OAuth token if ``FANDJANGO_USER_CACHE_TIMEOUT`` is set.
+
+        :param user: A ``User`` instance.
+        """
+        if USER_CACHE_TIMEOUT is not None:
+            cache.set_many({
+                get_user_cache_key(user.facebook_id): user,
+                get_oauth_token_cache_key(user.oauth_token.token): user.facebook_id
+            }, USER_CACHE_TIMEOUT)
+
+class User(ChangeTrackingModel):
     """
     Instances of the User class represent Facebook users who
     have authorized the application.
@@ -73,14 +363,31 @@ class User(models.Model):
     oauth_token = models.OneToOneField('OAuthToken', verbose_name=_('OAuth token'))
     """An ``OAuthToken`` object."""
 
-    created_at = models.DateTimeField(_('created at'), auto_now_add=True)
+    created_at = models.DateTimeField(_('created at'), auto_now_add=True, db_index=True)
     """A ``datetime`` object describing when the user was registered."""
 
-    last_seen_at = models.DateTimeField(_('last seen at'), auto_now_add=True)
+    last_seen_at = models.DateTimeField(_('last seen at'), auto_now_add=True, db_index=True)
     """A ``datetime`` object describing when the user was last seen."""
 
+    synchronized_at = models.DateTimeField(_('synchronized at'), blank=True, null=True)
+    """A ``datetime`` object describing when the user was last synchronized with Facebook (or ``None`` if he/she hasn't been)."""
+
+    picture_url = models.CharField(_('picture url'), max_length=1024, blank=True, null=True)
+    """A string describing the URL to the user's profile picture, as of when it was last resolved."""
+
+    picture_resolved_at = models.DateTimeField(_('picture resolved at'), blank=True, null=True)
+    """A ``datetime`` object describing when ``picture_url`` was resolved (or ``None`` if it hasn't been)."""
+
+    granted_permissions = models.TextField(_('granted permissions'), blank=True, null=True)
+    """A string describing a comma-separated list of permissions the user has granted the application, as of ``permissions_synchronized_at``."""
+
+    permissions_synchronized_at = models.DateTimeField(_('permissions synchronized at'), blank=True, null=True)
+    """A ``datetime`` object describing when the user's permissions were last synchronized with Facebook (or ``None`` if they haven't been)."""
+
     extra_data = jsonfield.JSONField()
-    """A ``JSONField`` object containing all additional facebook data."""
+    """A ``JSONField`` object containing all additional facebook data, loaded when it is first accessed."""
+
+    objects = UserManager()
 
     @property
     def full_name(self):
@@ -91,12 +398,36 @@ class User(models.Model):
             return "%s %s" % (self.first_name, self.last_name)
 
     @property
-    @cached(days=30)
+    @cached(seconds=PICTURE_CACHE_TIMEOUT)
     def picture(self):
         """
         A string describing the URL to the user's profile picture.
+
+        See also ``User.objects.resolve_pictures`` to resolve the pictures of many users at once.
         """
-        return requests.get('http://graph.facebook.com/%s/picture' % self.facebook_id).url
+        if self.picture_expired:
+            try:
+                response = transport.session.get('%s/%s/picture' % (GRAPH_API_URL, self.facebook_id), timeout=get_timeout())
+                response.raise_for_status()
+            except requests.RequestException:
+                # Fall back to the picture that was resolved last, if any
+                if self.picture_url:
+                    return self.picture_url
+                raise
+
+            self.picture_url = response.url
+            self.picture_resolved_at = now()
+            self.save(update_fields=['picture_url', 'picture_resolved_at'])
+
+        return self.picture_url
+
+    @property
+    def picture_expired(self):
+        """Determine whether ``picture_url`` is missing or was resolved too long ago to be relied on."""
+        if not self.picture_url or not self.picture_resolved_at:
+            return True
+
+        return self.picture_resolved_at < now() - timedelta(seconds=PICTURE_CACHE_TIMEOUT)
 
     @property
     def permissions(self):
@@ -114,6 +445,27 @@ class User(models.Model):
 
         return permissions
 
+    def get_granted_permissions(self, refresh=False):
+        """
+        Return a set of strings describing permissions the user has granted your application,
+        synchronizing them with Facebook if they haven't been for ``FANDJANGO_PERMISSIONS_TIMEOUT`` seconds.
+
+        :param refresh: A boolean describing whether to synchronize the permissions with Facebook regardless.
+        """
+        if refresh or not self.permissions_synchronized_at \
+            or self.permissions_synchronized_at < now() - timedelta(seconds=PERMISSIONS_TIMEOUT):
+            self.synchronize_permissions()
+
+        return set(filter(None, (self.granted_permissions or '').split(',')))
+
+    def synchronize_permissions(self):
+        """
+        Synchronize ``granted_permissions`` with Facebook.
+        """
+        self.granted_permissions = ','.join(sorted(self.permissions))
+        self.permissions_synchronized_at = now()
+        self.save()
+
     @property
     def graph(self):
         """
@@ -121,7 +473,7 @@ class User(models.Model):
 
         .. _Facepy: http://github.com/jgorset/facepy
         """
-        return GraphAPI(self.oauth_token.token)
+        return get_graph_api(self.oauth_token.token)
 
     def synchronize(self, graph_data=None):
         """
@@ -132,16 +484,32 @@ class User(models.Model):
         """
         profile = graph_data or self.graph.get('me')
 
+        # Load ``extra_data`` to tell whether it has changed
+        self._load_deferred_values()
+        self.apply_profile(profile)
+
+        # Don't write anything if the user's profile hasn't changed since it was last synchronized
+        if self.changed_fields or not self.synchronized_at:
+            self.synchronized_at = now()
+            self.save()
+
+    def apply_profile(self, profile):
+        """
+        Set ``facebook_username``, ``first_name``, ``middle_name``, ``last_name``, ``birthday``
+        and the user's other details from the given profile without saving them.
+
+        :param profile: A dictionary describing the user's profile as returned by the Graph API.
+        """
         self.facebook_username = profile.get('username')
         self.first_name = profile.get('first_name')
         self.middle_name = profile.get('middle_name')
         self.last_name = profile.get('last_name')
-        self.birthday = datetime.strptime(profile['birthday'], '%m/%d/%Y') if profile.has_key('birthday') else None
+        self.birthday = datetime.strptime(profile['birthday'], '%m/%d/%Y').date() if profile.has_key('birthday') else None
         self.email = profile.get('email')
         self.locale = profile.get('locale')
         self.gender = profile.get('gender')
-        self.extra_data = profile
-        self.save()
+        # Facepy includes the headers of the response with the profile
+        self.extra_data = dict((key, value) for key, value in profile.items() if key != 'headers')
 
     def __unicode__(self):
         if self.full_name:
@@ -154,8 +522,22 @@ class User(models.Model):
     class Meta:
         verbose_name = _('user')
         verbose_name_plural = _('users')
+        # ``fandjango_sync`` selects authorized users by when they were last synchronized.
+        index_together = [
+            ['authorized', 'synchronized_at']
+        ]
+
+class OAuthTokenManager(models.Manager):
 
-class OAuthToken(models.Model):
+    def get_by_token(self, token):
+        """
+        Get the OAuth token with the given value by its indexed digest.
+
+        :param token: A string describing an OAuth token.
+        """
+        return self.get(get_token_query(token))
+
+class OAuthToken(ChangeTrackingModel):
     """
     Instances of the OAuthToken class are credentials used to query
     the Facebook API on behalf of a user.
@@ -164,12 +546,17 @@ class OAuthToken(models.Model):
     token = models.TextField(_('token'))
     """A string describing the OAuth token itself."""
 
+    token_digest = models.CharField(_('token digest'), max_length=40, db_index=True, editable=False, blank=True, null=True)
+    """A string describing the SHA-1 digest of the token, by which tokens are looked up."""
+
     issued_at = models.DateTimeField(_('issued at'))
     """A ``datetime`` object describing when the token was issued."""
 
-    expires_at = models.DateTimeField(_('expires at'), null=True, blank=True)
+    expires_at = models.DateTimeField(_('expires at'), null=True, blank=True, db_index=True)
     """A ``datetime`` object describing when the token expires (or ``None`` if it doesn't)"""
 
+    objects = OAuthTokenManager()
+
     @property
     def expired(self):
         """Determine whether the OAuth token has expired."""
@@ -185,7 +572,16 @@ class OAuthToken(models.Model):
 
     def extend(self):
         """Extend the OAuth token."""
-        graph = GraphAPI()
+        self.token, self.expires_at = self.exchange()
+
+        self.save()
+
+    def exchange(self):
+        """
+        Exchange the OAuth token for a long-lived one without saving it, returning a tuple
+        of a string describing the new token and a ``datetime`` object describing when it expires.
+        """
+        graph = get_graph_api()
 
         response = graph.get('oauth/access_token',
             client_id = FACEBOOK_APPLICATION_ID,
@@ -196,11 +592,60 @@ class OAuthToken(models.Model):
 
         components = parse_qs(response)
 
-        self.token = components['access_token'][0]
-        self.expires_at = now() + timedelta(seconds = int(components['expires'][0]))
+        return components['access_token'][0], now() + timedelta(seconds = int(components['expires'][0]))
 
-        self.save()
+    def save(self, *args, **kwargs):
+        self.token_digest = get_token_digest(self.token)
+        super(OAuthToken, self).save(*args, **kwargs)
 
     class Meta:
         verbose_name = _('OAuth token')
         verbose_name_plural = _('OAuth tokens')
+
+def get_token_digest(token):
+    """Return the SHA-1 digest of the given OAuth token."""
+    return hashlib.sha1(force_bytes(token)).hexdigest()
+
+def get_token_query(token, prefix=''):
+    """
+    Return a ``Q`` object matching the OAuth token with the given value by its indexed digest or, if it
+    was saved without one (as versions that predate digests still do during a deploy), by its value.
+
+    :param token: A string describing an OAuth token.
+    :param prefix: A string to prefix the names of the fields with, such as ``'oauth_token__'``.
+    """
+    return Q(**{prefix + 'token': token}) & (
+        Q(**{prefix + 'token_digest': get_token_digest(token)}) | Q(**{prefix + 'token_digest__isnull': True})
+    )
+
+def get_user_cache_key(facebook_id):
+    """Return the key users with the given Facebook ID are cached under."""
+    return 'fandjango.User.facebook_id_%s' % facebook_id
+
+def get_oauth_token_cache_key(token):
+    """Return the key the Facebook ID of the owner of the given OAuth token is cached under."""
+    return 'fandjango.User.oauth_token_%s' % get_token_digest(token)
+
+# Receivers are connected for all senders and check the class of the instance themselves, since
+# instances of which fields have been deferred are of a subclass of their model.
+
+def invalidate_cached_user(sender, instance, **kwargs):
+    """Remove the given user from the cache."""
+    if USER_CACHE_TIMEOUT is not None and isinstance(instance, User):
+        cache.delete(get_user_cache_key(instance.facebook_id))
+
+def invalidate_cached_oauth_token(sender, instance, **kwargs):
+    """Remove the given OAuth token and the user it belongs to from the cache."""
+    if USER_CACHE_TIMEOUT is not None and isinstance(instance, OAuthToken):
+        keys = [get_oauth_token_cache_key(instance.token)]
+
+        if kwargs.get('signal') is post_save:
+            for facebook_id in User.objects.filter(oauth_token=instance).values_list('facebook_id', flat=True):
+                keys.append(get_user_cache_key(facebook_id))
+
+        cache.delete_many(keys)
+
+post_save.connect(invalidate_cached_user)
+post_delete.connect(invalidate_cached_user)
+post_save.connect(invalidate_cached_oauth_token)
+post_delete.connect(invalidate_cached_oauth_token)
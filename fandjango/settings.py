@@ -1,6 +1,7 @@
 from warnings import warn
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 
 # A string describing the Facebook application's ID.
 FACEBOOK_APPLICATION_ID = getattr(settings, 'FACEBOOK_APPLICATION_ID')
@@ -23,6 +24,12 @@ DISABLED_PATHS = getattr(settings, 'FANDJANGO_DISABLED_PATHS', [])
 # A list of regular expressions describing paths on which Fandjango should be enabled.
 ENABLED_PATHS = getattr(settings, 'FANDJANGO_ENABLED_PATHS', [])
 
+if ENABLED_PATHS and DISABLED_PATHS:
+    raise ImproperlyConfigured(
+        'You may configure either FANDJANGO_ENABLED_PATHS '
+        'or FANDJANGO_DISABLED_PATHS, but not both.'
+    )
+
 # A string describing a view that will be rendered for users that refuse to authorize the application.
 AUTHORIZATION_DENIED_VIEW = getattr(settings, 'FANDJANGO_AUTHORIZATION_DENIED_VIEW', 'fandjango.views.authorization_denied')
 
@@ -38,3 +45,75 @@ FANDJANGO_CACHE_SIGNED_REQUEST = getattr(settings, 'FACEBOOK_SIGNED_REQUEST_COOK
 
 # A string describing the website URL.
 FANDJANGO_SITE_URL = getattr(settings, 'FANDJANGO_SITE_URL', None)
+
+# An integer describing how many verified signed requests to keep in memory.
+SIGNED_REQUEST_CACHE_SIZE = getattr(settings, 'FANDJANGO_SIGNED_REQUEST_CACHE_SIZE', 1000)
+
+# An integer describing the number of seconds during which repeated visits will not update
+# a user's ``last_seen_at``, or ``None`` to update it on every request.
+LAST_SEEN_RESOLUTION = getattr(settings, 'FANDJANGO_LAST_SEEN_RESOLUTION', None)
+
+# An integer describing the number of seconds between writes of buffered ``last_seen_at`` updates.
+LAST_SEEN_FLUSH_INTERVAL = getattr(settings, 'FANDJANGO_LAST_SEEN_FLUSH_INTERVAL', 60)
+
+# An integer describing how many values of cached properties to keep in memory in each process.
+LOCAL_CACHE_SIZE = getattr(settings, 'FANDJANGO_LOCAL_CACHE_SIZE', 1000)
+
+# An integer describing the number of seconds to keep values of cached properties in memory before
+# reading them from the cache backend again. Other processes see invalidations only once it has passed.
+LOCAL_CACHE_TIMEOUT = getattr(settings, 'FANDJANGO_LOCAL_CACHE_TIMEOUT', 30)
+
+# An integer describing the number of seconds to cache users and their OAuth tokens for,
+# or ``None`` to query the database on every request.
+USER_CACHE_TIMEOUT = getattr(settings, 'FANDJANGO_USER_CACHE_TIMEOUT', None)
+
+# An integer describing the number of threads that run background tasks such as extending
+# OAuth tokens, or ``0`` to run them during the request.
+BACKGROUND_WORKERS = getattr(settings, 'FANDJANGO_BACKGROUND_WORKERS', 1)
+
+# An integer describing how many background tasks may be queued at once.
+BACKGROUND_QUEUE_SIZE = getattr(settings, 'FANDJANGO_BACKGROUND_QUEUE_SIZE', 1000)
+
+# A boolean describing whether to extend users' OAuth tokens when they make requests, or leave
+# extending them to the ``fandjango_extend_tokens`` command.
+EXTEND_OAUTH_TOKENS_ON_REQUEST = getattr(settings, 'FANDJANGO_EXTEND_OAUTH_TOKENS_ON_REQUEST', True)
+
+# An integer describing the number of seconds to wait before attempting to extend an OAuth token
+# that could not be extended. The delay doubles with every consecutive failure.
+EXTEND_OAUTH_TOKEN_BACKOFF = getattr(settings, 'FANDJANGO_EXTEND_OAUTH_TOKEN_BACKOFF', 3600)
+
+# A string describing the URL of the Graph API.
+GRAPH_API_URL = getattr(settings, 'FANDJANGO_GRAPH_API_URL', 'https://graph.facebook.com')
+
+# A number describing the number of seconds to wait for the Graph API to respond, or ``None`` to wait indefinitely.
+GRAPH_API_TIMEOUT = getattr(settings, 'FANDJANGO_GRAPH_API_TIMEOUT', 10)
+
+# A number describing the number of seconds to wait for a connection to the Graph API, or ``None``
+# to wait as long as ``FANDJANGO_GRAPH_API_TIMEOUT``.
+GRAPH_API_CONNECT_TIMEOUT = getattr(settings, 'FANDJANGO_GRAPH_API_CONNECT_TIMEOUT', None)
+
+# An integer describing how many times requests of the Graph API that fail (or time out) are retried.
+GRAPH_API_RETRIES = getattr(settings, 'FANDJANGO_GRAPH_API_RETRIES', 0)
+
+# An integer describing how many connections to each of Facebook's hosts to keep open in each process.
+GRAPH_API_POOL_SIZE = getattr(settings, 'FANDJANGO_GRAPH_API_POOL_SIZE', 10)
+
+# An integer describing how many batched Graph API requests may be made concurrently.
+GRAPH_API_CONCURRENCY = getattr(settings, 'FANDJANGO_GRAPH_API_CONCURRENCY', 4)
+
+# A boolean describing whether to batch requests of the Graph API made by views (see ``fandjango.graph.batching``).
+GRAPH_API_BATCHING = getattr(settings, 'FANDJANGO_GRAPH_API_BATCHING', False)
+
+# A boolean describing whether to defer looking up the user until ``request.facebook.user`` is accessed.
+LAZY_USER = getattr(settings, 'FANDJANGO_LAZY_USER', False)
+
+# A boolean describing whether to time each stage of processing requests and send the
+# ``fandjango.signals.request_timed`` signal with the result.
+TIMING = getattr(settings, 'FANDJANGO_TIMING', False)
+
+# A boolean describing whether to add the timing of each request to its response's ``Server-Timing`` header.
+SERVER_TIMING_HEADER = getattr(settings, 'FANDJANGO_SERVER_TIMING_HEADER', False)
+
+# An integer describing the number of seconds to rely on the permissions users have granted
+# the application before synchronizing them with Facebook again.
+PERMISSIONS_TIMEOUT = getattr(settings, 'FANDJANGO_PERMISSIONS_TIMEOUT', 3600)
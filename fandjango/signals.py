@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent once the response to a request processed by Fandjango's middleware is ready.
+# ``timing`` is a ``fandjango.timing.Timing`` instance. Only sent if ``FANDJANGO_TIMING`` is enabled.
+request_timed = Signal(providing_args=['request', 'timing'])
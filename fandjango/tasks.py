@@ -0,0 +1,206 @@
+import atexit
+import logging
+import os
+import time
+from Queue import Queue, Full
+from threading import Thread, Lock
+
+from django.core.cache import cache
+from django.db import close_connection
+
+from fandjango.models import User, OAuthToken
+from fandjango.settings import (
+    BACKGROUND_WORKERS, BACKGROUND_QUEUE_SIZE, EXTEND_OAUTH_TOKEN_BACKOFF
+)
+
+logger = logging.getLogger(__name__)
+
+class Executor(object):
+    """
+    Run tasks on a pool of daemon threads fed by a bounded queue.
+
+    Tasks are identified by a key, and tasks are discarded while another task with the same
+    key is waiting or running. If the executor has no workers, tasks are run immediately.
+    """
+
+    def __init__(self, workers, size):
+        """
+        Initialize an executor.
+
+        :param workers: An integer describing the number of threads to run tasks on.
+        :param size: An integer describing how many tasks may be queued at once.
+        """
+        self.workers = workers
+        self.size = size
+        self.lock = Lock()
+        self.pid = None
+        self.keys = set()
+        self.queue = Queue(size)
+
+    def submit(self, key, function, *args, **kwargs):
+        """
+        Queue a task, returning ``False`` if it was discarded because a task with the same key
+        is already queued or the queue is full.
+
+        :param key: A hashable object identifying the task.
+        :param function: A callable to run.
+        """
+        with self.lock:
+            # Starting the executor in a new process forgets the keys of its parent's tasks,
+            # so it must be started before the key is recorded.
+            if self.workers:
+                self.start()
+
+            if key in self.keys:
+                return False
+
+            self.keys.add(key)
+
+        if not self.workers:
+            self.run(key, function, args, kwargs)
+            return True
+
+        try:
+            self.queue.put_nowait((key, function, args, kwargs))
+        except Full:
+            with self.lock:
+                self.keys.discard(key)
+            return False
+
+        return True
+
+    def start(self):
+        """Start the threads unless they were already started by this process."""
+        if self.pid == os.getpid():
+            return
+
+        # Threads do not survive forking, so processes forked from one that had
+        # already started the executor must start their own.
+        self.pid = os.getpid()
+        self.keys = set()
+        self.queue = Queue(self.size)
+
+        for i in range(self.workers):
+            thread = Thread(target=self.work, name='fandjango-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def work(self):
+        """Run queued tasks forever."""
+        queue = self.queue
+
+        while True:
+            key, function, args, kwargs = queue.get()
+
+            try:
+                self.run(key, function, args, kwargs)
+            finally:
+                close_connection()
+                queue.task_done()
+
+    def run(self, key, function, args, kwargs):
+        """Run a task, logging any exception it raises."""
+        try:
+            function(*args, **kwargs)
+        except Exception:
+            logger.exception('Background task %r failed', key)
+        finally:
+            with self.lock:
+                self.keys.discard(key)
+
+    def drain(self, timeout=None):
+        """
+        Wait for queued tasks to finish, returning ``False`` if they did not finish in time.
+
+        :param timeout: An integer describing the number of seconds to wait, or ``None`` to wait indefinitely.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+
+        return True
+
+executor = Executor(BACKGROUND_WORKERS, BACKGROUND_QUEUE_SIZE)
+
+atexit.register(executor.drain, 30)
+
+def get_extension_backoff_cache_key(oauth_token):
+    """Return the key failed attempts to extend the given OAuth token are recorded under."""
+    return 'fandjango.OAuthToken.extension_backoff_%s' % oauth_token.pk
+
+def is_extension_backed_off(oauth_token):
+    """Determine whether an attempt to extend the given OAuth token failed too recently to try again."""
+    backoff = cache.get(get_extension_backoff_cache_key(oauth_token))
+
+    return bool(backoff and backoff['retry_at'] > time.time())
+
+def record_extension_failure(oauth_token):
+    """
+    Record that an attempt to extend the given OAuth token failed, and back off from trying again
+    for ``FANDJANGO_EXTEND_OAUTH_TOKEN_BACKOFF`` seconds, doubling with every consecutive failure.
+
+    Returns an integer describing the number of consecutive failed attempts.
+    """
+    key = get_extension_backoff_cache_key(oauth_token)
+
+    backoff = cache.get(key) or {'attempts': 0}
+
+    attempts = backoff['attempts'] + 1
+    delay = min(EXTEND_OAUTH_TOKEN_BACKOFF * 2 ** (attempts - 1), 86400 * 7)
+
+    cache.set(key, {'attempts': attempts, 'retry_at': time.time() + delay}, delay * 2)
+
+    return attempts
+
+def extend_oauth_token(oauth_token):
+    """
+    Extend the given OAuth token in the background, unless an earlier attempt to extend it failed recently.
+
+    :param oauth_token: An ``OAuthToken`` instance.
+    """
+    if is_extension_backed_off(oauth_token):
+        return False
+
+    return executor.submit(('extend_oauth_token', oauth_token.pk), _extend_oauth_token, oauth_token.pk)
+
+def _extend_oauth_token(pk):
+    try:
+        oauth_token = OAuthToken.objects.get(pk=pk)
+    except OAuthToken.DoesNotExist:
+        return
+
+    if oauth_token.extended:
+        return
+
+    # Attempt to extend the OAuth token, but back off on exceptions raised by
+    # bug #102727766518358 in the Facebook Platform so as not to retry on every request.
+    #
+    # http://developers.facebook.com/bugs/102727766518358/
+    try:
+        oauth_token.extend()
+    except Exception:
+        attempts = record_extension_failure(oauth_token)
+
+        logger.warning('Could not extend OAuth token %s (attempt %d)', pk, attempts, exc_info=True)
+    else:
+        cache.delete(get_extension_backoff_cache_key(oauth_token))
+
+def synchronize_user(user):
+    """
+    Synchronize the given user with Facebook in the background, unless he/she has been synchronized already.
+
+    :param user: A ``User`` instance.
+    """
+    return executor.submit(('synchronize_user', user.pk), _synchronize_user, user.pk)
+
+def _synchronize_user(pk):
+    try:
+        user = User.objects.select_related('oauth_token').get(pk=pk)
+    except User.DoesNotExist:
+        return
+
+    if not user.synchronized_at:
+        user.synchronize()
@@ -0,0 +1,82 @@
+import time
+from collections import OrderedDict
+
+from fandjango.settings import TIMING
+
+class Timing(object):
+    """
+    Timing instances record how long each stage of processing a request took.
+    """
+
+    durations = None
+    """An ordered dictionary mapping the name of each stage to the number of seconds spent in it."""
+
+    reported = False
+    """A boolean describing whether the timing has been reported."""
+
+    def __init__(self):
+        self.durations = OrderedDict()
+
+    def stage(self, name):
+        """
+        Return a context manager that adds the time spent in it to the given stage.
+
+        :param name: A string describing the stage.
+        """
+        return Stage(self, name)
+
+    def add(self, name, seconds):
+        """
+        Add the given number of seconds to the given stage.
+
+        :param name: A string describing the stage.
+        :param seconds: A float describing the number of seconds spent in the stage.
+        """
+        self.durations[name] = self.durations.get(name, 0) + seconds
+
+    def header(self):
+        """Return a string describing the timing in the format of the ``Server-Timing`` header."""
+        return ', '.join('%s;dur=%.2f' % (name, seconds * 1000) for name, seconds in self.durations.items())
+
+class Stage(object):
+
+    def __init__(self, timing, name):
+        self.timing, self.name = timing, name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.timing.add(self.name, time.time() - self.start)
+
+class NullTiming(object):
+    """
+    NullTiming instances stand in for ``Timing`` when timing is disabled, and record nothing.
+    """
+
+    def stage(self, name):
+        return self
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+null_timing = NullTiming()
+
+def get_timing(request):
+    """
+    Return the ``Timing`` instance of the given request, or a ``NullTiming`` instance
+    if ``FANDJANGO_TIMING`` is disabled.
+
+    :param request: An ``HttpRequest`` instance.
+    """
+    if not TIMING:
+        return null_timing
+
+    try:
+        return request.fandjango_timing
+    except AttributeError:
+        request.fandjango_timing = Timing()
+        return request.fandjango_timing
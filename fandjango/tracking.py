@@ -0,0 +1,110 @@
+import atexit
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+
+from django.db import close_connection
+
+from fandjango.models import User
+from fandjango.utils import LRUCache, bulk_update
+from fandjango.settings import LAST_SEEN_RESOLUTION, LAST_SEEN_FLUSH_INTERVAL
+
+try:
+    from django.utils.timezone import now
+except ImportError:
+    def now():
+        return datetime.now()
+
+logger = logging.getLogger(__name__)
+
+class LastSeenBuffer(object):
+    """
+    Buffer updates to users' ``last_seen_at`` in memory and write them in batches.
+
+    Each user is updated at most once per ``resolution``, and pending updates are written
+    by a thread of their own every ``interval`` in as few ``UPDATE`` statements as possible,
+    each user being given the time he/she was seen.
+
+    The buffer remembers when it last recorded each of the ``size`` most recently seen users, since
+    users read from the cache carry the ``last_seen_at`` they were cached with.
+    """
+
+    def __init__(self, resolution, interval, size=10000):
+        """
+        Initialize a buffer.
+
+        :param resolution: An integer describing the number of seconds during which repeated
+                           visits will not update the user.
+        :param interval: An integer describing the number of seconds between writes.
+        :param size: An integer describing how many users to remember the last update of.
+        """
+        self.resolution = timedelta(seconds=resolution)
+        self.interval = timedelta(seconds=interval)
+        self.pending = {}
+        self.seen = LRUCache(size)
+        self.lock = Lock()
+        self.pid = None
+
+    def touch(self, user):
+        """
+        Record that the given user was seen just now.
+
+        :param user: A ``User`` instance.
+        """
+        timestamp = now()
+
+        with self.lock:
+            last_seen_at = max([
+                seen_at for seen_at in (self.pending.get(user.pk), self.seen.get(user.pk), user.last_seen_at) if seen_at
+            ] or [None])
+
+            if last_seen_at and timestamp - last_seen_at < self.resolution:
+                return
+
+            self.start()
+
+            self.pending[user.pk] = user.last_seen_at = timestamp
+            self.seen.set(user.pk, timestamp)
+
+    def start(self):
+        """Start the thread that flushes pending updates unless it was already started by this process."""
+        if self.pid == os.getpid():
+            return
+
+        # Threads do not survive forking, so processes forked from one that had already
+        # started the thread must start their own. Updates pending in the parent are its own to write.
+        self.pid = os.getpid()
+        self.pending = {}
+
+        thread = Thread(target=self.work, name='fandjango-last-seen')
+        thread.daemon = True
+        thread.start()
+
+    def work(self):
+        """Flush pending updates every ``interval`` forever."""
+        while True:
+            time.sleep(self.interval.days * 86400 + self.interval.seconds)
+
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to write buffered updates to last_seen_at')
+            finally:
+                close_connection()
+
+    def flush(self):
+        """Write pending updates to the database."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        users = [User(pk=pk, last_seen_at=timestamp) for pk, timestamp in sorted(pending.items())]
+
+        bulk_update(users, {'last_seen_at': users})
+
+if LAST_SEEN_RESOLUTION is not None:
+    last_seen = LastSeenBuffer(LAST_SEEN_RESOLUTION, LAST_SEEN_FLUSH_INTERVAL)
+    atexit.register(last_seen.flush)
+else:
+    last_seen = None
@@ -1,10 +1,16 @@
 import re
+import hashlib
+from time import time, sleep
 from datetime import timedelta
 from urlparse import urlparse
 from functools import wraps
+from collections import OrderedDict
+from threading import Event, Lock
 
 from django.core.cache import cache
+from django.db import connections, router, transaction
 from django.utils.importlib import import_module
+from django.utils.encoding import force_bytes
 
 from fandjango.settings import FACEBOOK_APPLICATION_CANVAS_URL
 from fandjango.settings import FACEBOOK_APPLICATION_DOMAIN
@@ -13,6 +19,170 @@ from fandjango.settings import DISABLED_PATHS
 from fandjango.settings import ENABLED_PATHS
 from fandjango.settings import AUTHORIZATION_DENIED_VIEW
 from fandjango.settings import FANDJANGO_SITE_URL
+from fandjango.settings import FACEBOOK_APPLICATION_SECRET_KEY
+from fandjango.settings import SIGNED_REQUEST_CACHE_SIZE
+from fandjango.settings import LOCAL_CACHE_SIZE, LOCAL_CACHE_TIMEOUT
+
+from facepy import SignedRequest
+
+class LRUCache(object):
+    """A thread-safe mapping that holds at most ``size`` items, discarding the least recently used."""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the value for the given key and mark it as recently used.
+
+        :param key: A hashable object describing the item.
+        :param default: An object to return if the key is not cached.
+        """
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        """
+        Cache the given value, discarding the least recently used item if the cache is full.
+
+        :param key: A hashable object describing the item.
+        :param value: An object to cache.
+        """
+        if self.size <= 0:
+            return
+
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        """Discard the given key if it is cached."""
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        """Discard all items."""
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+signed_requests = LRUCache(SIGNED_REQUEST_CACHE_SIZE)
+
+def parse_signed_request(signed_request):
+    """
+    Verify and parse a signed request, reusing the result of previous verifications
+    of the same string until its OAuth token expires.
+
+    Signed requests are shared between requests and must not be modified.
+
+    :param signed_request: A string describing a signed request.
+    :raises SignedRequest.Error: If the signed request is invalid.
+    """
+    key = hashlib.sha1(force_bytes(signed_request)).hexdigest()
+
+    parsed_signed_request = signed_requests.get(key)
+
+    if parsed_signed_request is not None:
+        oauth_token = parsed_signed_request.user.oauth_token
+
+        if not oauth_token or not oauth_token.has_expired:
+            return parsed_signed_request
+
+        signed_requests.delete(key)
+
+    parsed_signed_request = SignedRequest(
+        signed_request = signed_request,
+        application_secret_key = FACEBOOK_APPLICATION_SECRET_KEY
+    )
+
+    oauth_token = parsed_signed_request.user.oauth_token
+
+    if not oauth_token or not oauth_token.has_expired:
+        signed_requests.set(key, parsed_signed_request)
+
+    return parsed_signed_request
+
+def is_equivalent_signed_request(signed_request, other_signed_request):
+    """
+    Determine whether two signed requests carry the same payload (i.e. whether
+    they generate the same signed request).
+
+    :param signed_request: A ``SignedRequest`` instance.
+    :param other_signed_request: A ``SignedRequest`` instance.
+    """
+    def describe(signed_request):
+        page, user = signed_request.page, signed_request.user
+
+        return (
+            signed_request.data,
+            (page.id, page.is_liked, page.is_admin) if page else None,
+            user.id, user.locale, user.country,
+            (user.age[0], user.age[-1]) if user.age else None,
+            (user.oauth_token.token, user.oauth_token.issued_at, user.oauth_token.expires_at) if user.oauth_token else None
+        )
+
+    return describe(signed_request) == describe(other_signed_request)
+
+class PathMatcher(object):
+    """
+    Match paths against a list of regular expressions, compiled into a single
+    expression, and remember the outcome for recently matched paths.
+
+    Patterns with inline flags (which would apply to all of the patterns) or references to
+    numbered groups (which would refer to other groups) are compiled on their own.
+    """
+
+    separate_pattern = re.compile(r'\(\?[iLmsux]+\)|\\[1-9]|\(\?\([1-9]')
+
+    def __init__(self, patterns, cache_size=1000):
+        """
+        Initialize a path matcher.
+
+        :param patterns: A list of strings describing regular expressions.
+        :param cache_size: An integer describing how many paths to remember the outcome for.
+        """
+        self.results = LRUCache(cache_size)
+
+        combined = [pattern for pattern in patterns if not self.separate_pattern.search(pattern)]
+        separate = [pattern for pattern in patterns if self.separate_pattern.search(pattern)]
+
+        try:
+            self.expressions = [re.compile('|'.join('(?:%s)' % pattern for pattern in combined))] if combined else []
+        except (AssertionError, OverflowError, re.error):
+            # The patterns have too many groups between them (or groups of the same name) to be combined.
+            self.expressions = [re.compile(pattern) for pattern in combined]
+
+        self.expressions.extend(re.compile(pattern) for pattern in separate)
+
+    def match(self, path):
+        """
+        Determine whether or not the path matches one or more of the patterns.
+
+        :param path: A string describing the path to be matched.
+        """
+        result = self.results.get(path)
+
+        if result is None:
+            result = any(expression.search(path[1:]) for expression in self.expressions)
+            self.results.set(path, result)
+
+        return result
+
+disabled_paths = PathMatcher(DISABLED_PATHS)
+
+enabled_paths = PathMatcher(ENABLED_PATHS)
 
 def is_disabled_path(path):
     """
@@ -21,11 +191,7 @@ def is_disabled_path(path):
 
     :param path: A string describing the path to be matched.
     """
-    for disabled_path in DISABLED_PATHS:
-        match = re.search(disabled_path, path[1:])
-        if match:
-            return True
-    return False
+    return disabled_paths.match(path)
 
 def is_enabled_path(path):
     """
@@ -34,37 +200,308 @@ def is_enabled_path(path):
 
     :param path: A string describing the path to be matched.
     """
-    for enabled_path in ENABLED_PATHS:
-        match = re.search(enabled_path, path[1:])
-        if match:
-            return True
-    return False
+    return enabled_paths.match(path)
+
+# Values of cached properties are held in memory for ``FANDJANGO_LOCAL_CACHE_TIMEOUT`` seconds in front
+# of the cache backend, where they are stored along with when they should be refreshed.
+cached_properties = LRUCache(LOCAL_CACHE_SIZE)
+
+# The versions of the cached properties of each model, along with when to read them again.
+cached_property_versions = {}
+
+# The names of all cached properties.
+cached_property_names = set()
+
+# The keys of the values of cached properties being computed by this process, mapped to events that
+# are set once they have been computed.
+cached_property_computations = {}
+cached_property_computations_lock = Lock()
+
+# The share of its lifetime before a cached value expires that it is refreshed in.
+CACHED_PROPERTY_EARLY_REFRESH = 0.1
+
+# The number of seconds other processes wait for a value being computed before computing it themselves.
+CACHED_PROPERTY_LOCK_TIMEOUT = 10
+
+# The number of seconds the versions of cached properties are kept in the cache backend for.
+CACHED_PROPERTY_VERSION_TIMEOUT = 30 * 86400
 
 def cached_property(**kwargs):
-    """Cache the return value of a property."""
+    """
+    Cache the return value of a property (including ``None``) for the given ``timedelta``.
+
+    Values are held in memory in front of the cache backend, recomputed by a single thread
+    and process at a time, and refreshed shortly before they expire while other threads and
+    processes carry on with the current value.
+    """
+    delta = timedelta(**kwargs)
+    timeout = delta.days * 86400 + delta.seconds
+
     def decorator(function):
+        cached_property_names.add(function.__name__)
+
         @wraps(function)
         def wrapper(self):
-            key = 'fandjango.%(model)s.%(property)s_%(pk)s' % {
-                'model': self.__class__.__name__,
-                'pk': self.pk,
-                'property': function.__name__
-            }
+            key = get_cached_property_key(self, function.__name__)
 
-            cached_value = cache.get(key)
+            entry = cached_properties.get(key)
 
-            delta = timedelta(**kwargs)
+            if entry is not None and entry[1] > time():
+                return entry[0]
 
-            if cached_value is None:
-                value = function(self)
-                cache.set(key, value, delta.days * 86400 + delta.seconds)
-            else:
-                value = cached_value
+            entry = cache.get(key)
+
+            if entry is None or entry[1] <= time():
+                entry = compute_cached_property(self, key, function, timeout, entry)
+
+            value, refresh_at = entry
+
+            cached_properties.set(key, (value, min(refresh_at, time() + LOCAL_CACHE_TIMEOUT)))
 
             return value
         return wrapper
     return decorator
 
+def compute_cached_property(instance, key, function, timeout, entry):
+    """
+    Return the value of the given property along with when it should be refreshed, given its current
+    entry (or ``None``), computing it unless another thread of this process is computing it already.
+    Other threads carry on with the current entry, or wait for the new one if there is none.
+    """
+    with cached_property_computations_lock:
+        computation = cached_property_computations.get(key)
+
+        if computation is None:
+            computation = cached_property_computations[key] = Event()
+            computing = True
+        else:
+            computing = False
+
+    if computing:
+        try:
+            return refresh_cached_property(instance, key, function, timeout)
+        finally:
+            with cached_property_computations_lock:
+                del cached_property_computations[key]
+
+            computation.set()
+
+    if entry is not None:
+        return entry
+
+    computation.wait(CACHED_PROPERTY_LOCK_TIMEOUT)
+
+    # The other thread may have failed to compute it.
+    return cache.get(key) or refresh_cached_property(instance, key, function, timeout)
+
+def refresh_cached_property(instance, key, function, timeout):
+    """
+    Return the cached value of the given property along with when it should be refreshed,
+    computing it if it is missing or due and no other process is computing it already.
+    """
+    lock = '%s.lock' % key
+
+    # Another thread may have refreshed it while this one waited for the lock.
+    entry = cache.get(key)
+
+    if entry is not None and entry[1] > time():
+        return entry
+
+    if not cache.add(lock, True, CACHED_PROPERTY_LOCK_TIMEOUT):
+
+        # Carry on with the current value while another process refreshes it...
+        if entry is not None:
+            return entry
+
+        # ... or wait for it to compute one.
+        deadline = time() + CACHED_PROPERTY_LOCK_TIMEOUT
+
+        while time() < deadline:
+            sleep(0.05)
+
+            entry = cache.get(key)
+
+            if entry is not None:
+                return entry
+
+    try:
+        entry = (function(instance), time() + timeout * (1 - CACHED_PROPERTY_EARLY_REFRESH))
+        cache.set(key, entry, timeout)
+    finally:
+        cache.delete(lock)
+
+    return entry
+
+def get_cached_property_key(instance, name):
+    """
+    Return the key the value of the given property of the given model instance is cached under.
+
+    :param instance: A model instance.
+    :param name: A string describing the name of the property.
+    """
+    return 'fandjango.%(model)s.%(version)s.%(property)s_%(pk)s' % {
+        'model': get_model_name(instance),
+        'version': get_cached_property_version(instance),
+        'pk': instance.pk,
+        'property': name
+    }
+
+def get_cached_property_version(model):
+    """
+    Return the current version of the cached properties of the given model, which
+    is changed to invalidate all of them at once.
+
+    :param model: A model class or instance.
+    """
+    name = get_model_name(model)
+
+    version, expires_at = cached_property_versions.get(name, (None, 0))
+
+    if expires_at > time():
+        return version
+
+    key = 'fandjango.%s.version' % name
+
+    version = cache.get(key)
+
+    if version is None:
+        version = int(time() * 1000)
+
+        if not cache.add(key, version, CACHED_PROPERTY_VERSION_TIMEOUT):
+            version = cache.get(key, version)
+
+    cached_property_versions[name] = (version, time() + LOCAL_CACHE_TIMEOUT)
+
+    return version
+
+def get_cached_properties(instances, name):
+    """
+    Return a dictionary mapping the primary key of each of the given model instances whose
+    given property is cached to its cached value.
+
+    :param instances: A list of model instances.
+    :param name: A string describing the name of the property.
+    """
+    keys = dict((get_cached_property_key(instance, name), instance.pk) for instance in instances)
+
+    return dict((keys[key], entry[0]) for key, entry in cache.get_many(keys.keys()).items())
+
+def set_cached_properties(name, values, **kwargs):
+    """
+    Cache the given values of the given property for the given ``timedelta``.
+
+    :param name: A string describing the name of the property.
+    :param values: A dictionary mapping model instances to values of the property.
+    """
+    delta = timedelta(**kwargs)
+    timeout = delta.days * 86400 + delta.seconds
+    refresh_at = time() + timeout * (1 - CACHED_PROPERTY_EARLY_REFRESH)
+
+    cache.set_many(dict(
+        (get_cached_property_key(instance, name), (value, refresh_at)) for instance, value in values.items()
+    ), timeout)
+
+def invalidate_cached_properties(instance):
+    """
+    Discard the cached values of all properties of the given model instance.
+
+    :param instance: A model instance.
+    """
+    keys = [get_cached_property_key(instance, name) for name in cached_property_names]
+
+    for key in keys:
+        cached_properties.delete(key)
+
+    cache.delete_many(keys)
+
+def invalidate_model_cached_properties(model):
+    """
+    Discard the cached values of all properties of all instances of the given model. Other processes
+    keep using values they hold in memory for up to ``FANDJANGO_LOCAL_CACHE_TIMEOUT`` seconds.
+
+    :param model: A model class.
+    """
+    name = get_model_name(model)
+    version = int(time() * 1000)
+
+    # Versions are compared for equality, so make sure it changes even within the same millisecond.
+    if version == cached_property_versions.get(name, (None, 0))[0]:
+        version += 1
+
+    cache.set('fandjango.%s.version' % name, version, CACHED_PROPERTY_VERSION_TIMEOUT)
+
+    cached_property_versions[name] = (version, time() + LOCAL_CACHE_TIMEOUT)
+
+def get_model_name(model):
+    """
+    Return the name of the given model, or of the model the given instance is of. Instances of which
+    fields have been deferred are of a subclass of their model with a name of its own.
+
+    :param model: A model class or instance.
+    """
+    return model._meta.concrete_model._meta.object_name
+
+# The number of parameters SQLite allows in a single statement, which other databases allow more of.
+MAX_QUERY_PARAMETERS = 999
+
+def bulk_update(instances, fields):
+    """
+    Write the given fields of the given model instances of the same model in as few ``UPDATE`` statements
+    as possible, without sending signals.
+
+    :param instances: A list of model instances.
+    :param fields: A dictionary mapping the names of fields to a list of the instances to write it for,
+                   all of which must be among ``instances``.
+    """
+    if not instances or not fields:
+        return
+
+    model = instances[0]._meta.concrete_model
+    using = router.db_for_write(model)
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    pk = quote_name(model._meta.pk.column)
+
+    # Each instance may take two parameters for each field and one for its primary key.
+    chunk_size = max(1, MAX_QUERY_PARAMETERS // (2 * len(fields) + 1))
+
+    for offset in range(0, len(instances), chunk_size):
+        chunk = instances[offset:offset + chunk_size]
+        pks = set(instance.pk for instance in chunk)
+
+        assignments = []
+        params = []
+
+        for name, changed in sorted(fields.items()):
+            field = model._meta.get_field(name)
+            changed = [instance for instance in changed if instance.pk in pks]
+
+            if not changed:
+                continue
+
+            assignments.append('%(column)s = CASE %(pk)s %(cases)s ELSE %(column)s END' % {
+                'column': quote_name(field.column),
+                'pk': pk,
+                'cases': ' '.join(['WHEN %s THEN %s'] * len(changed))
+            })
+
+            for instance in changed:
+                params.extend([instance.pk, field.get_db_prep_save(getattr(instance, field.attname), connection)])
+
+        if not assignments:
+            continue
+
+        params.extend(instance.pk for instance in chunk)
+
+        connection.cursor().execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+            quote_name(model._meta.db_table),
+            ', '.join(assignments),
+            pk,
+            ', '.join(['%s'] * len(chunk))
+        ), params)
+
+    transaction.commit_unless_managed(using=using)
+
 def authorization_denied_view(request):
     """Proxy for the view referenced in ``FANDJANGO_AUTHORIZATION_DENIED_VIEW``."""
     authorization_denied_module_name = AUTHORIZATION_DENIED_VIEW.rsplit('.', 1)[0]
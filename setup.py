@@ -18,6 +18,8 @@ setup(
     packages = [
         'fandjango',
         'fandjango.migrations',
+        'fandjango.management',
+        'fandjango.management.commands',
         'fandjango.templatetags'
     ],
     package_data = {
@@ -27,8 +29,8 @@ setup(
         ]
     },
     install_requires = [
-        'facepy >= 0.8',
-        'requests >= 0.8'
+        'facepy >= 1.0.9, < 1.1',
+        'requests >= 2.4'
     ],
     classifiers = [
         'Development Status :: 5 - Production/Stable',
@@ -1,11 +1,12 @@
 from django.conf.urls.defaults import *
 
-from views import home, places, redirect
+from views import home, places, redirect, profile
 
 urlpatterns = patterns('',
     url(r'^$', home, name='home'),
     url(r'^places$', places, name='places'),
     url(r'^redirect$', redirect, name='redirect'),
+    url(r'^profile$', profile, name='profile'),
 
     url('fandjango/', include('fandjango.urls'))
 )
@@ -13,3 +13,7 @@ def places(request):
 @facebook_authorization_required(redirect_uri="http://example.org")
 def redirect(request):
   return HttpResponse()
+
+@facebook_authorization_required(synchronize=True)
+def profile(request):
+    return HttpResponse(request.facebook.user.first_name)
@@ -25,3 +25,5 @@ SECRET_KEY = '123'
 USE_TZ = True
 
 DEBUG = True
+
+FANDJANGO_BACKGROUND_WORKERS = 0
@@ -3,23 +3,40 @@ import base64
 import hashlib
 import hmac
 import json
+import os
+import tempfile
 import unittest
+from StringIO import StringIO
 
 from django.test.client import Client
 from django.test.client import RequestFactory
+from django.http import HttpResponse
 from django.core.urlresolvers import reverse
 from django.core.management import call_command
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
 
 from fandjango.middleware import FacebookMiddleware, FacebookWebMiddleware
-from fandjango.models import User, OAuthToken
+from fandjango.models import Facebook, LazyFacebook, User, OAuthToken, get_user_cache_key
 from fandjango.utils import get_post_authorization_redirect_url
+from fandjango.utils import LRUCache, PathMatcher, parse_signed_request
+from fandjango.utils import cached_property, cached_properties, cached_property_versions, get_cached_property_key
+from fandjango.utils import invalidate_cached_properties, invalidate_model_cached_properties
+from fandjango.tracking import LastSeenBuffer
+from fandjango.tasks import Executor, extend_oauth_token, is_extension_backed_off
+from fandjango.graph import get_graph_api, transport, batching, get_current_batch
+from fandjango.signals import request_timed
 
 from .helpers import assert_contains
 
-from facepy import GraphAPI, SignedRequest
+from facepy import GraphAPI, SignedRequest, FacepyError
 
 from mock import patch
+from requests import Session
+from threading import Thread
+
+from benchmarks.graph_server import GraphServer
 
 try:
     from django.utils.timezone import now
@@ -112,6 +129,138 @@ class TestFacebookMiddleware(unittest.TestCase):
 
         assert request.method == 'GET'
 
+    def test_lazy_user(self):
+        """
+        Verify that the user may be looked up upon first accessing it.
+        """
+        facebook_middleware = FacebookMiddleware()
+
+        with patch.object(GraphAPI, 'get') as graph_get:
+            graph_get.return_value = TEST_GRAPH_ME_RESPONSE
+
+            with patch('fandjango.middleware.LAZY_USER', True):
+                request = request_factory.post(
+                    path = reverse('home'),
+                    data = {
+                        'signed_request': TEST_SIGNED_REQUEST
+                    }
+                )
+
+                facebook_middleware.process_request(request)
+
+                assert request.facebook
+                assert not request.facebook.evaluated
+                assert not User.objects.exists()
+
+                assert request.facebook.user.facebook_id == 12345
+                assert User.objects.exists()
+
+    def test_lazy_user_assignment(self):
+        """
+        Verify that assigning to the user or OAuth token of a lazy ``Facebook`` instance looks them up
+        first, so that the assigned value isn't overwritten once they are.
+        """
+        lookups = []
+
+        def get_user():
+            lookups.append(None)
+            return 'user', 'oauth token'
+
+        facebook = LazyFacebook(get_user)
+        facebook.user = 'other user'
+
+        assert facebook.evaluated
+        assert facebook.user == 'other user'
+        assert facebook.oauth_token == 'oauth token'
+
+        facebook.oauth_token = 'other oauth token'
+
+        assert facebook.oauth_token == 'other oauth token'
+        assert len(lookups) == 1
+
+    def test_signed_request_cookie(self):
+        """
+        Verify that the signed request is only saved to a cookie if the cookie
+        does not carry it already.
+        """
+        facebook_middleware = FacebookMiddleware()
+
+        with patch.object(GraphAPI, 'get') as graph_get:
+            graph_get.return_value = TEST_GRAPH_ME_RESPONSE
+
+            request = request_factory.post(
+                path = reverse('home'),
+                data = {
+                    'signed_request': TEST_SIGNED_REQUEST
+                }
+            )
+
+            facebook_middleware.process_request(request)
+            response = facebook_middleware.process_response(request, HttpResponse())
+
+            assert 'signed_request' in response.cookies
+
+            request = request_factory.get(
+                path = reverse('home')
+            )
+            request.COOKIES['signed_request'] = TEST_SIGNED_REQUEST
+
+            facebook_middleware.process_request(request)
+            response = facebook_middleware.process_response(request, HttpResponse())
+
+            assert 'signed_request' not in response.cookies
+
+    def test_timing(self):
+        """
+        Verify that the time spent in each stage of processing the request is reported.
+        """
+        facebook_middleware = FacebookMiddleware()
+        timings = []
+
+        def receiver(sender, request, timing, **kwargs):
+            timings.append(timing)
+
+        request_timed.connect(receiver)
+
+        try:
+            with patch.object(GraphAPI, 'get') as graph_get:
+                graph_get.return_value = TEST_GRAPH_ME_RESPONSE
+
+                request = request_factory.post(
+                    path = reverse('home'),
+                    data = {
+                        'signed_request': TEST_SIGNED_REQUEST
+                    }
+                )
+
+                facebook_middleware.process_request(request)
+                response = facebook_middleware.process_response(request, HttpResponse())
+
+                assert not hasattr(request, 'fandjango_timing')
+                assert not response.has_header('Server-Timing')
+                assert not timings
+
+                with patch('fandjango.timing.TIMING', True):
+                    with patch('fandjango.middleware.SERVER_TIMING_HEADER', True):
+                        request = request_factory.post(
+                            path = reverse('home'),
+                            data = {
+                                'signed_request': TEST_SIGNED_REQUEST
+                            }
+                        )
+
+                        facebook_middleware.process_request(request)
+                        response = facebook_middleware.process_response(request, HttpResponse())
+                        facebook_middleware.process_response(request, response)
+        finally:
+            request_timed.disconnect(receiver)
+
+        assert timings == [request.fandjango_timing]
+        assert 'signed_request' in request.fandjango_timing.durations
+        assert 'user' in request.fandjango_timing.durations
+        assert response['Server-Timing'].startswith('signed_request;dur=')
+        assert 'user;dur=' in response['Server-Timing']
+
     def test_application_authorization(self):
         """
         Verify that the user is redirected to authorize the application
@@ -264,6 +413,34 @@ class TestFacebookMiddleware(unittest.TestCase):
 
             user.synchronize()
 
+    def test_synchronization_required(self):
+        """
+        Verify that views may require users to be synchronized with Facebook.
+        """
+        User.objects.create(
+            facebook_id = 12345,
+            oauth_token = OAuthToken.objects.create(
+                token = TEST_ACCESS_TOKEN,
+                issued_at = now(),
+                expires_at = now() + timedelta(days = 1)
+            )
+        )
+
+        client = Client()
+
+        with patch.object(GraphAPI, 'get') as graph_get:
+            graph_get.return_value = TEST_GRAPH_ME_RESPONSE
+
+            response = client.post(
+                path = reverse('profile'),
+                data = {
+                    'signed_request': TEST_SIGNED_REQUEST
+                }
+            )
+
+        assert response.content == TEST_GRAPH_ME_RESPONSE['first_name']
+        assert User.objects.get(facebook_id=12345).synchronized_at
+
     def test_user_permissions(self):
         """
         Verify that users maintain a list of permissions granted to the application.
@@ -294,6 +471,84 @@ class TestFacebookMiddleware(unittest.TestCase):
 
             assert 'installed' in user.permissions
 
+    def test_granted_permissions(self):
+        """
+        Verify that the permissions users have granted the application are stored, and only
+        synchronized with Facebook once they are stale or the user seems to be lacking some.
+        """
+        client = Client()
+
+        with patch.object(GraphAPI, 'get') as graph_get:
+            graph_get.return_value = {}
+
+            client.post(
+                path = reverse('home'),
+                data = {
+                    'signed_request': TEST_SIGNED_REQUEST
+                }
+            )
+
+        with patch.object(GraphAPI, 'get') as graph_get:
+            graph_get.return_value = {
+                'data': [
+                    {'permission': 'installed', 'status': 'granted'},
+                    {'permission': 'checkins', 'status': 'granted'}
+                ]
+            }
+
+            for i in range(2):
+                response = client.post(
+                    path = reverse('places'),
+                    data = {
+                        'signed_request': TEST_SIGNED_REQUEST
+                    }
+                )
+
+                assert response.status_code == 200
+
+            assert graph_get.call_count == 1
+            assert User.objects.get(id=1).get_granted_permissions() == set(['installed', 'checkins'])
+
+        User.objects.filter(id=1).update(granted_permissions='installed')
+
+        with patch.object(GraphAPI, 'get') as graph_get:
+            graph_get.return_value = {
+                'data': [
+                    {'permission': 'installed', 'status': 'granted'},
+                    {'permission': 'checkins', 'status': 'declined'}
+                ]
+            }
+
+            response = client.post(
+                path = reverse('places'),
+                data = {
+                    'signed_request': TEST_SIGNED_REQUEST
+                }
+            )
+
+            assert response.status_code == 401
+            assert graph_get.call_count == 1
+
+        User.objects.filter(id=1).update(granted_permissions=None, permissions_synchronized_at=None)
+
+        with patch.object(GraphAPI, 'get') as graph_get:
+            graph_get.return_value = {
+                'data': [
+                    {'permission': 'installed', 'status': 'granted'},
+                    {'permission': 'checkins', 'status': 'declined'}
+                ]
+            }
+
+            response = client.post(
+                path = reverse('places'),
+                data = {
+                    'signed_request': TEST_SIGNED_REQUEST
+                }
+            )
+
+            assert response.status_code == 401
+            assert graph_get.call_count == 1
+
     def test_extend_oauth_token(self):
         """
         Verify that OAuth access tokens may be extended.
@@ -321,6 +576,58 @@ class TestFacebookMiddleware(unittest.TestCase):
         # the expiration time will have to suffice.
         assert user.oauth_token.expires_at
 
+    def test_graph_api_timeout(self):
+        """
+        Verify that Fandjango gives up on slow responses from the Graph API.
+        """
+        graph = get_graph_api(TEST_ACCESS_TOKEN)
+
+        assert graph.oauth_token == TEST_ACCESS_TOKEN
+        assert graph.timeout == 10
+
+        server = GraphServer(('127.0.0.1', 0), latency=0.5, jitter=0)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            with patch('fandjango.graph.GRAPH_API_URL', server.url):
+                with patch('fandjango.graph.GRAPH_API_TIMEOUT', 0.1):
+                    self.assertRaises(FacepyError, get_graph_api('token-1').get, 'me')
+
+            # Timeouts are not retried, so as not to hold on to the request for longer.
+            assert server.calls == 1
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_graph_api_connection_pool(self):
+        """
+        Verify that connections to the Graph API are kept alive and shared.
+        """
+        server = GraphServer(('127.0.0.1', 0), latency=0, jitter=0)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            with patch('fandjango.graph.GRAPH_API_URL', server.url):
+                assert get_graph_api('token-1').session is get_graph_api('token-2').session
+
+                with patch.object(Session, '__init__') as session_init:
+                    get_graph_api('token-1')
+
+                    assert not session_init.called
+
+                for i in range(3):
+                    assert get_graph_api('token-1').get('me')['id'] == '1'
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        statistics = transport.get_statistics()[server.url]
+
+        assert statistics['requests'] == 3
+        assert statistics['connections'] == 1
+
     def test_get_post_authorization_redirect_url(self):
         """
         Verify that Fandjango redirects the user correctly upon authorizing the application.
@@ -330,6 +637,48 @@ class TestFacebookMiddleware(unittest.TestCase):
 
         assert redirect_url == 'https://apps.facebook.com/fandjango-test/bar/baz'
 
+    def test_signed_request_cache(self):
+        """
+        Verify that signed requests are only verified once.
+        """
+        signed_request = parse_signed_request(TEST_SIGNED_REQUEST)
+
+        with patch.object(SignedRequest, 'parse') as parse:
+            assert parse_signed_request(TEST_SIGNED_REQUEST) is signed_request
+            assert not parse.called
+
+    def test_lru_cache(self):
+        """
+        Verify that the least recently used items are discarded.
+        """
+        cache = LRUCache(size=2)
+
+        cache.set('foo', 1)
+        cache.set('bar', 2)
+        cache.get('foo')
+        cache.set('baz', 3)
+
+        assert cache.get('foo') == 1
+        assert cache.get('bar') is None
+        assert cache.get('baz') == 3
+
+    def test_path_matcher(self):
+        """
+        Verify that paths are matched against any of the given patterns.
+        """
+        matcher = PathMatcher([r'^foo/', r'^(bar)/(baz)$'])
+
+        assert matcher.match('/foo/bar')
+        assert matcher.match('/bar/baz')
+        assert not matcher.match('/baz')
+        assert not PathMatcher([]).match('/foo/bar')
+
+        matcher = PathMatcher(['^Admin', '(?i)^static', r'^(b)\1'])
+
+        assert matcher.match('/STATIC/foo')
+        assert not matcher.match('/admin/foo')
+        assert matcher.match('/bb')
+
     def test_authed_user_doesnt_get_redirected(self):
         """
         Verify that authorizing the application will register a new user.
@@ -566,6 +915,38 @@ class TestFacebookWebMiddleware(unittest.TestCase):
         # the expiration time will have to suffice.
         assert user.oauth_token.expires_at
 
+    def test_oauth_token_lookup(self):
+        """
+        Verify that OAuth tokens are looked up by their digest.
+        """
+        oauth_token = OAuthToken.objects.create(
+            token = TEST_ACCESS_TOKEN,
+            issued_at = now(),
+            expires_at = now() + timedelta(days = 1)
+        )
+
+        assert oauth_token.token_digest == hashlib.sha1(TEST_ACCESS_TOKEN).hexdigest()
+        assert OAuthToken.objects.get_by_token(TEST_ACCESS_TOKEN) == oauth_token
+
+    def test_oauth_token_lookup_without_digest(self):
+        """
+        Verify that OAuth tokens saved without a digest are looked up by their value.
+        """
+        user = User.objects.create(
+            facebook_id = 12345,
+            oauth_token = OAuthToken.objects.create(
+                token = TEST_ACCESS_TOKEN,
+                issued_at = now(),
+                expires_at = now() + timedelta(days = 1)
+            )
+        )
+
+        OAuthToken.objects.filter(pk=user.oauth_token.pk).update(token_digest=None)
+
+        assert OAuthToken.objects.get_by_token(TEST_ACCESS_TOKEN) == user.oauth_token
+        assert User.objects.get_by_oauth_token(TEST_ACCESS_TOKEN).pk == user.pk
+        self.assertRaises(OAuthToken.DoesNotExist, OAuthToken.objects.get_by_token, 'foo')
+
     def test_get_post_authorization_redirect_url(self):
         """
         Verify that Fandjango redirects the user correctly upon authorizing the application.
@@ -648,6 +1029,739 @@ class TestFacebookWebMiddleware(unittest.TestCase):
 
         assert OAuthToken.objects.count() == 1
 
+class TestLastSeenBuffer(unittest.TestCase):
+
+    def tearDown(self):
+        call_command('flush', interactive=False)
+
+    def test_coalescing(self):
+        """
+        Verify that repeated visits are coalesced into a single write.
+        """
+        user = User.objects.create(
+            facebook_id = 12345,
+            oauth_token = OAuthToken.objects.create(
+                token = TEST_ACCESS_TOKEN,
+                issued_at = now(),
+                expires_at = now() + timedelta(days = 1)
+            )
+        )
+
+        User.objects.filter(pk=user.pk).update(last_seen_at=now() - timedelta(days=1))
+        user = User.objects.get(pk=user.pk)
+
+        buffer = LastSeenBuffer(resolution=300, interval=3600)
+
+        buffer.touch(user)
+        buffer.touch(User.objects.get(pk=user.pk))
+
+        assert len(buffer.pending) == 1
+        assert User.objects.get(pk=user.pk).last_seen_at < now() - timedelta(hours=1)
+
+        buffer.flush()
+
+        assert not buffer.pending
+        assert User.objects.get(pk=user.pk).last_seen_at > now() - timedelta(hours=1)
+
+    def test_stale_user(self):
+        """
+        Verify that users carrying the ``last_seen_at`` they were cached with are not updated again.
+        """
+        user = User.objects.create(
+            facebook_id = 12345,
+            oauth_token = OAuthToken.objects.create(
+                token = TEST_ACCESS_TOKEN,
+                issued_at = now(),
+                expires_at = now() + timedelta(days = 1)
+            )
+        )
+
+        User.objects.filter(pk=user.pk).update(last_seen_at=now() - timedelta(days=1))
+        cached_user = User.objects.get(pk=user.pk)
+
+        buffer = LastSeenBuffer(resolution=300, interval=3600)
+
+        buffer.touch(User.objects.get(pk=user.pk))
+        buffer.flush()
+
+        buffer.touch(cached_user)
+
+        assert not buffer.pending
+
+    def test_timestamps(self):
+        """
+        Verify that each user is given the time he/she was seen, and that pending updates are flushed periodically.
+        """
+        users = [
+            User.objects.create(
+                facebook_id = facebook_id,
+                oauth_token = OAuthToken.objects.create(
+                    token = 'token-%d' % facebook_id,
+                    issued_at = now(),
+                    expires_at = now() + timedelta(days = 1)
+                )
+            )
+            for facebook_id in range(1, 4)
+        ]
+
+        User.objects.update(last_seen_at=now() - timedelta(days=1))
+        users = list(User.objects.order_by('facebook_id'))
+
+        buffer = LastSeenBuffer(resolution=300, interval=3600)
+        seen_at = now().replace(microsecond=0)
+
+        for hours, user in enumerate(users):
+            with patch('fandjango.tracking.now', return_value=seen_at - timedelta(hours=hours)):
+                buffer.touch(user)
+
+        queries = len(connection.queries)
+
+        buffer.flush()
+
+        # PostgreSQL can't assign a CASE of parameters alone to a timestamp column.
+        assert 'ELSE' in connection.queries[queries]['sql']
+
+        for hours, user in enumerate(users):
+            assert User.objects.get(pk=user.pk).last_seen_at == seen_at - timedelta(hours=hours)
+
+        with patch('fandjango.tracking.time.sleep', side_effect=[None, SystemExit]):
+            with patch.object(buffer, 'flush') as flush:
+                self.assertRaises(SystemExit, buffer.work)
+
+                assert flush.call_count == 1
+
+class TestChangeTracking(unittest.TestCase):
+
+    def tearDown(self):
+        call_command('flush', interactive=False)
+
+    def test_changed_fields(self):
+        """
+        Verify that only fields that have changed are saved.
+        """
+        User.objects.create(
+            facebook_id = 12345,
+            oauth_token = OAuthToken.objects.create(
+                token = TEST_ACCESS_TOKEN,
+                issued_at = now(),
+                expires_at = now() + timedelta(days = 1)
+            )
+        )
+
+        user = User.objects.get(facebook_id=12345)
+
+        assert user.changed_fields == []
+
+        user.first_name = 'Foo'
+
+        assert user.changed_fields == ['first_name']
+
+        queries = len(connection.queries)
+
+        user.save()
+
+        assert 'first_name' in connection.queries[-1]['sql']
+        assert 'extra_data' not in connection.queries[-1]['sql']
+        assert user.changed_fields == []
+
+        user.save()
+
+        assert len(connection.queries) == queries + 1
+
+    def test_synchronize_unchanged_profile(self):
+        """
+        Verify that synchronizing a profile that hasn't changed doesn't write anything, even
+        though the headers Facepy includes with it have.
+        """
+        user = User.objects.create(
+            facebook_id = 12345,
+            oauth_token = OAuthToken.objects.create(
+                token = TEST_ACCESS_TOKEN,
+                issued_at = now(),
+                expires_at = now() + timedelta(days = 1)
+            )
+        )
+
+        user.synchronize(dict(TEST_GRAPH_ME_RESPONSE, headers={'Date': 'Sun, 18 Oct 2026 16:00:00 GMT'}))
+
+        assert 'headers' not in user.extra_data
+
+        queries = len(connection.queries)
+
+        user.synchronize(dict(TEST_GRAPH_ME_RESPONSE, headers={'Date': 'Sun, 18 Oct 2026 16:00:01 GMT'}))
+
+        assert len(connection.queries) == queries
+
+class TestUserRegistration(unittest.TestCase):
+
+    def tearDown(self):
+        call_command('flush', interactive=False)
+
+    def test_concurrent_registration(self):
+        """
+        Verify that registering a user that has already been registered
+        updates his/her OAuth token instead of failing.
+        """
+        user, registered = User.objects.register(
+            facebook_id = 12345,
+            token = TEST_ACCESS_TOKEN,
+            issued_at = now(),
+            expires_at = now() + timedelta(days = 1)
+        )
+
+        assert registered
+
+        user, registered = User.objects.register(
+            facebook_id = 12345,
+            token = 'FGHIJ',
+            issued_at = now(),
+            expires_at = now() + timedelta(days = 1)
+        )
+
+        assert not registered
+        assert User.objects.count() == 1
+        assert User.objects.get(facebook_id=12345).oauth_token.token == 'FGHIJ'
+
+class TestUserCache(unittest.TestCase):
+
+    def tearDown(self):
+        call_command('flush', interactive=False)
+        cache.clear()
+
+    def test_user_cache(self):
+        """
+        Verify that cached users are read without querying the database
+        and removed from the cache upon saving.
+        """
+        with patch('fandjango.models.USER_CACHE_TIMEOUT', 60):
+            User.objects.create(
+                facebook_id = 12345,
+                oauth_token = OAuthToken.objects.create(
+                    token = TEST_ACCESS_TOKEN,
+                    issued_at = now(),
+                    expires_at = now() + timedelta(days = 1)
+                )
+            )
+
+            User.objects.get_by_facebook_id(12345)
+
+            queries = len(connection.queries)
+
+            user = User.objects.get_by_facebook_id(12345)
+
+            assert user.oauth_token.token == TEST_ACCESS_TOKEN
+            assert User.objects.get_by_oauth_token(TEST_ACCESS_TOKEN).pk == user.pk
+            assert len(connection.queries) == queries
+
+            user.oauth_token.expires_at = now() + timedelta(days = 2)
+            user.oauth_token.save()
+
+            assert cache.get(get_user_cache_key(12345)) is None
+
+            User.objects.get_by_facebook_id(12345)
+            user.first_name = 'Foo'
+            user.save()
+
+            assert cache.get(get_user_cache_key(12345)) is None
+
+    def test_deferred_extra_data(self):
+        """
+        Verify that users are loaded and saved without ``extra_data`` until it's accessed,
+        and that they are removed from the cache and share cache keys all the same.
+        """
+        with patch('fandjango.models.USER_CACHE_TIMEOUT', 60):
+            User.objects.create(
+                facebook_id = 12345,
+                oauth_token = OAuthToken.objects.create(
+                    token = TEST_ACCESS_TOKEN,
+                    issued_at = now(),
+                    expires_at = now() + timedelta(days = 1)
+                ),
+                extra_data = {'link': 'http://www.foo.com'}
+            )
+
+            user = User.objects.get_by_facebook_id(12345)
+
+            assert 'extra_data' not in user.__dict__
+            assert get_cached_property_key(user, 'picture') == get_cached_property_key(User._base_manager.get(pk=user.pk), 'picture')
+
+            queries = len(connection.queries)
+
+            user.first_name = 'Foo'
+            user.save()
+
+            assert 'extra_data' not in connection.queries[queries]['sql']
+            assert cache.get(get_user_cache_key(12345)) is None
+
+            user = User.objects.get(pk=user.pk)
+            user._load_deferred_values()
+
+            assert user.extra_data is not None
+            assert not user.changed_fields
+
+            user = User.objects.get(pk=user.pk)
+
+            assert user.extra_data is not None
+            assert 'extra_data' in user.__dict__
+            assert not user.changed_fields
+
+            queries = len(connection.queries)
+
+            user.last_name = 'Bar'
+            user.save()
+
+            assert 'extra_data' not in connection.queries[queries]['sql']
+
+            user.extra_data = {'link': 'http://www.bar.com'}
+
+            assert user.changed_fields == ['extra_data']
+
+class TestUserPictures(unittest.TestCase):
+
+    def tearDown(self):
+        call_command('flush', interactive=False)
+        cache.clear()
+        cached_properties.clear()
+        cached_property_versions.clear()
+
+    def test_resolve_pictures(self):
+        """
+        Verify that the pictures of many users are resolved in batched requests,
+        and saved and cached so that they don't have to be resolved again.
+        """
+        for facebook_id in range(1, 61):
+            User.objects.create(
+                facebook_id = facebook_id,
+                oauth_token = OAuthToken.objects.create(
+                    token = 'token-%d' % facebook_id,
+                    issued_at = now(),
+                    expires_at = now() + timedelta(days = 1)
+                )
+            )
+
+        def batch(batch):
+            return [
+                {'code': 200, 'body': json.dumps({'data': {'url': 'http://example.org/%s.jpg' % request['relative_url'].split('/')[0]}})}
+                for request in json.loads(batch)
+            ]
+
+        with patch.object(GraphAPI, 'post') as graph_post:
+            graph_post.side_effect = lambda **kwargs: batch(kwargs['batch'])
+
+            pictures = User.objects.resolve_pictures(User.objects.all())
+
+            assert graph_post.call_count == 2
+            assert len(pictures) == 60
+            assert pictures[7] == 'http://example.org/7.jpg'
+            assert User.objects.get(facebook_id=7).picture_url == 'http://example.org/7.jpg'
+
+            User.objects.resolve_pictures(User.objects.all())
+
+            assert graph_post.call_count == 2
+
+        with patch.object(Session, 'get') as session_get:
+            cache.clear()
+
+            assert User.objects.get(facebook_id=7).picture == 'http://example.org/7.jpg'
+            assert not session_get.called
+
+    def test_expired_pictures(self):
+        """
+        Verify that pictures that were resolved too long ago are resolved again,
+        and only relied on if they can't be.
+        """
+        for facebook_id in range(1, 3):
+            User.objects.create(
+                facebook_id = facebook_id,
+                oauth_token = OAuthToken.objects.create(
+                    token = 'token-%d' % facebook_id,
+                    issued_at = now(),
+                    expires_at = now() + timedelta(days = 1)
+                ),
+                picture_url = 'http://example.org/old.jpg',
+                picture_resolved_at = now() - timedelta(days = 60)
+            )
+
+        with patch.object(GraphAPI, 'post') as graph_post:
+            graph_post.return_value = [
+                {'code': 200, 'body': json.dumps({'data': {'url': 'http://example.org/new.jpg'}})},
+                {'code': 500, 'body': json.dumps({'error': {'message': 'An unexpected error has occurred.', 'code': 2}})}
+            ]
+
+            pictures = User.objects.resolve_pictures(User.objects.order_by('facebook_id'))
+
+            assert pictures == {1: 'http://example.org/new.jpg', 2: 'http://example.org/old.jpg'}
+            assert not User.objects.get(facebook_id=1).picture_expired
+            assert User.objects.get(facebook_id=2).picture_expired
+
+        with patch.object(Session, 'get') as session_get:
+            session_get.return_value.url = 'http://example.org/newer.jpg'
+
+            User.objects.filter(facebook_id=1).update(picture_resolved_at=now() - timedelta(days = 60))
+            cache.clear()
+            cached_properties.clear()
+
+            assert User.objects.get(facebook_id=1).picture == 'http://example.org/newer.jpg'
+            assert User.objects.get(facebook_id=1).picture_url == 'http://example.org/newer.jpg'
+
+class TestGraphBatching(unittest.TestCase):
+
+    def test_batching(self):
+        """
+        Verify that requests of the Graph API made while batching are made in a single
+        batch request once the result of one of them is used.
+        """
+        with patch.object(GraphAPI, 'post') as graph_post:
+            graph_post.return_value = [
+                {'code': 200, 'body': json.dumps(TEST_GRAPH_ME_RESPONSE)},
+                {'code': 400, 'body': json.dumps({'error': {'message': 'Invalid token', 'type': 'OAuthException', 'code': 190}})}
+            ]
+
+            with batching():
+                profile = get_graph_api('token-1').get('me', fields=['first_name', 'last_name'])
+                permissions = get_graph_api('token-2').get('me/permissions')
+
+                assert not graph_post.called
+
+            assert profile['first_name'] == 'Foo'
+            assert profile.get('last_name') == 'Bar'
+            assert graph_post.call_count == 1
+
+            requests = json.loads(graph_post.call_args[1]['batch'])
+
+            assert requests[0]['relative_url'] == 'me?fields=first_name%2Clast_name&access_token=token-1'
+            assert requests[1]['relative_url'] == 'me/permissions?access_token=token-2'
+
+            self.assertRaises(GraphAPI.OAuthError, lambda: permissions['data'])
+
+    def test_failed_batch(self):
+        """
+        Verify that every result of a batch request that fails raises its exception.
+        """
+        with patch.object(GraphAPI, 'post') as graph_post:
+            graph_post.side_effect = FacepyError('Timed out')
+
+            with batching():
+                profile = get_graph_api('token-1').get('me')
+                permissions = get_graph_api('token-2').get('me/permissions')
+
+            self.assertRaises(FacepyError, lambda: profile['first_name'])
+            self.assertRaises(FacepyError, lambda: permissions['data'])
+
+            assert graph_post.call_count == 1
+
+    def test_request_batching(self):
+        """
+        Verify that requests of the Graph API made by views are batched if
+        ``FANDJANGO_GRAPH_API_BATCHING`` is enabled.
+        """
+        facebook_middleware = FacebookMiddleware()
+
+        request = request_factory.get(reverse('home'))
+        request.facebook = Facebook()
+
+        with patch('fandjango.middleware.GRAPH_API_BATCHING', True):
+            facebook_middleware.process_view(request, None, (), {})
+
+            assert get_current_batch() is not None
+
+            facebook_middleware.process_response(request, HttpResponse())
+
+            assert get_current_batch() is None
+
+class TestCachedProperty(unittest.TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(
+            facebook_id = 12345,
+            oauth_token = OAuthToken.objects.create(
+                token = TEST_ACCESS_TOKEN,
+                issued_at = now(),
+                expires_at = now() + timedelta(days = 1)
+            )
+        )
+
+        self.calls = []
+
+        @cached_property(seconds=60)
+        def nothing(user):
+            self.calls.append(user)
+
+        self.nothing = nothing
+
+    def tearDown(self):
+        call_command('flush', interactive=False)
+        cache.clear()
+        cached_properties.clear()
+        cached_property_versions.clear()
+
+    def test_cached_property(self):
+        """
+        Verify that values (including ``None``) are cached in memory in front of the cache backend.
+        """
+        assert self.nothing(self.user) is None
+        assert self.nothing(self.user) is None
+        assert len(self.calls) == 1
+
+        cached_properties.clear()
+
+        assert self.nothing(self.user) is None
+        assert len(self.calls) == 1
+
+        with patch.object(cache, 'get') as cache_get:
+            assert self.nothing(self.user) is None
+            assert not cache_get.called
+
+    def test_cached_property_invalidation(self):
+        """
+        Verify that cached properties may be invalidated per instance and per model.
+        """
+        self.nothing(self.user)
+
+        invalidate_cached_properties(self.user)
+        self.nothing(self.user)
+
+        assert len(self.calls) == 2
+
+        invalidate_model_cached_properties(User)
+        self.nothing(self.user)
+
+        assert len(self.calls) == 3
+
+    def test_cached_property_refresh(self):
+        """
+        Verify that values due to be refreshed are only recomputed by one process,
+        while others carry on with the current value.
+        """
+        key = get_cached_property_key(self.user, 'nothing')
+
+        cache.set(key, ('stale', time() - 1), 60)
+        cache.add('%s.lock' % key, True)
+
+        assert self.nothing(self.user) == 'stale'
+        assert not self.calls
+
+        cached_properties.clear()
+        cache.delete('%s.lock' % key)
+
+        assert self.nothing(self.user) is None
+        assert len(self.calls) == 1
+
+    def test_cached_property_computation(self):
+        """
+        Verify that values due to be refreshed are only recomputed by one thread, while others
+        carry on with the current value rather than waiting for it.
+        """
+        from threading import Event
+
+        computing, computed = Event(), Event()
+
+        @cached_property(seconds=60)
+        def slow(user):
+            computing.set()
+            computed.wait(5)
+            return 'fresh'
+
+        cache.set(get_cached_property_key(self.user, 'slow'), ('stale', time() - 1), 60)
+
+        thread = Thread(target=slow, args=(self.user,))
+        thread.start()
+
+        try:
+            assert computing.wait(5)
+            assert slow(self.user) == 'stale'
+            assert self.nothing(self.user) is None
+        finally:
+            computed.set()
+            thread.join()
+
+        cached_properties.clear()
+
+        assert slow(self.user) == 'fresh'
+
+class TestCommands(unittest.TestCase):
+
+    def setUp(self):
+        for facebook_id in range(1, 6):
+            User.objects.create(
+                facebook_id = facebook_id,
+                oauth_token = OAuthToken.objects.create(
+                    token = 'token-%d' % facebook_id,
+                    issued_at = now(),
+                    expires_at = now() + timedelta(days = 1)
+                )
+            )
+
+    def tearDown(self):
+        call_command('flush', interactive=False)
+        cache.clear()
+
+    def test_sync(self):
+        """
+        Verify that users that haven't been synchronized recently are synchronized in batch requests.
+        """
+        User.objects.filter(facebook_id=5).update(synchronized_at=now())
+
+        def batch(batch):
+            return [
+                {'code': 200, 'body': json.dumps(dict(TEST_GRAPH_ME_RESPONSE, id=request['relative_url'].split('token-')[1]))}
+                for request in json.loads(batch)
+            ]
+
+        checkpoint = tempfile.mktemp()
+
+        with patch.object(GraphAPI, 'post') as graph_post:
+            graph_post.side_effect = lambda **kwargs: batch(kwargs['batch'])
+
+            call_command('fandjango_sync', chunk_size=2, checkpoint=checkpoint, stdout=StringIO())
+
+            assert graph_post.call_count == 2
+            assert User.objects.filter(first_name='Foo', synchronized_at__isnull=False).count() == 4
+            assert User.objects.get(facebook_id=5).first_name is None
+            assert not os.path.exists(checkpoint)
+
+            call_command('fandjango_sync', stdout=StringIO())
+
+            assert graph_post.call_count == 2
+
+    def test_sync_writes_and_failures(self):
+        """
+        Verify that the details of synchronized users are written in bulk, and that users
+        that could not be synchronized are backed off from.
+        """
+        def batch(batch):
+            return [
+                {'code': 500, 'body': json.dumps({'error': {'message': 'An unexpected error has occurred.', 'code': 2}})}
+                if request['relative_url'].endswith('token-1') else
+                {'code': 200, 'body': json.dumps(dict(TEST_GRAPH_ME_RESPONSE, id=request['relative_url'].split('token-')[1]))}
+                for request in json.loads(batch)
+            ]
+
+        with patch.object(GraphAPI, 'post') as graph_post:
+            graph_post.side_effect = lambda **kwargs: batch(kwargs['batch'])
+
+            queries = len(connection.queries)
+
+            call_command('fandjango_sync', stdout=StringIO())
+
+            updates = [query for query in connection.queries[queries:] if query['sql'].startswith('UPDATE')]
+
+            assert len(updates) == 2
+            assert User.objects.filter(first_name='Foo', synchronized_at__isnull=False).count() == 4
+            assert User.objects.get(facebook_id=1).synchronized_at is None
+
+            call_command('fandjango_sync', stdout=StringIO())
+
+            assert graph_post.call_count == 1
+
+    def test_extend_tokens(self):
+        """
+        Verify that OAuth tokens that expire soon are extended, and failures are backed off from.
+        """
+        OAuthToken.objects.filter(token='token-5').update(expires_at=now() + timedelta(days=30))
+
+        def exchange(path, **options):
+            if options['fb_exchange_token'] == 'token-4':
+                raise GraphAPI.FacebookError('Invalid token', 190)
+
+            return 'access_token=extended-%s&expires=5184000' % options['fb_exchange_token']
+
+        outcomes = tempfile.mktemp()
+
+        with patch.object(GraphAPI, 'get') as graph_get:
+            graph_get.side_effect = exchange
+
+            call_command('fandjango_extend_tokens', workers=2, chunk_size=2, outcomes=outcomes, stdout=StringIO())
+
+            assert graph_get.call_count == 4
+
+        assert OAuthToken.objects.get(pk=User.objects.get(facebook_id=1).oauth_token_id).token == 'extended-token-1'
+        assert OAuthToken.objects.get(pk=User.objects.get(facebook_id=1).oauth_token_id).extended
+        assert OAuthToken.objects.filter(token='token-4').exists()
+        assert OAuthToken.objects.filter(token='token-5').exists()
+
+        with open(outcomes) as f:
+            lines = [json.loads(line) for line in f]
+
+        os.remove(outcomes)
+
+        assert sorted(line['outcome'] for line in lines) == ['extended', 'extended', 'extended', 'failed']
+        assert is_extension_backed_off(OAuthToken.objects.get(token='token-4'))
+
+    def test_reap_tokens(self):
+        """
+        Verify that OAuth tokens that no user references are deleted once they have expired or been abandoned.
+        """
+        OAuthToken.objects.filter(token='token-1').update(expires_at=now() - timedelta(days = 1))
+
+        for token, issued_at, expires_at in [
+            ('expired', now() - timedelta(days = 2), now() - timedelta(days = 1)),
+            ('abandoned', now() - timedelta(days = 2), now() + timedelta(days = 1)),
+            ('fresh', now(), now() + timedelta(days = 1))
+        ]:
+            OAuthToken.objects.create(token=token, issued_at=issued_at, expires_at=expires_at)
+
+        call_command('fandjango_reap_tokens', batch_size=1, pause=0, stdout=StringIO())
+
+        assert sorted(OAuthToken.objects.values_list('token', flat=True)) == [
+            'fresh', 'token-1', 'token-2', 'token-3', 'token-4', 'token-5'
+        ]
+        assert User.objects.count() == 5
+
+class TestTasks(unittest.TestCase):
+
+    def tearDown(self):
+        call_command('flush', interactive=False)
+        cache.clear()
+
+    def test_executor(self):
+        """
+        Verify that the executor runs tasks in the background and discards duplicates.
+        """
+        from threading import Event
+
+        executor = Executor(workers=1, size=10)
+        event = Event()
+        results = []
+
+        assert executor.submit('foo', event.wait)
+        assert not executor.submit('foo', event.wait)
+        assert executor.submit('bar', results.append, 'bar')
+        assert not executor.submit('bar', results.append, 'bar')
+
+        event.set()
+
+        assert executor.drain(timeout=5)
+        assert results == ['bar']
+
+    def test_extend_oauth_token_backoff(self):
+        """
+        Verify that OAuth tokens that could not be extended are not retried right away.
+        """
+        oauth_token = OAuthToken.objects.create(
+            token = TEST_ACCESS_TOKEN,
+            issued_at = now(),
+            expires_at = now() + timedelta(days = 1)
+        )
+
+        with patch.object(GraphAPI, 'get') as graph_get:
+            graph_get.side_effect = GraphAPI.FacebookError('Error', 1)
+
+            extend_oauth_token(oauth_token)
+            extend_oauth_token(oauth_token)
+
+        assert graph_get.call_count == 1
+
+        with patch.object(GraphAPI, 'get') as graph_get:
+            graph_get.return_value = '&access_token=%s&expires=%d' % ('ABCDE', 5184000)
+
+            # Forget the failed attempt
+            cache.clear()
+
+            extend_oauth_token(oauth_token)
+
+        assert OAuthToken.objects.get(pk=oauth_token.pk).extended
+
 class TestFacebookMultipleMiddleware(unittest.TestCase):
 
     def setUp(self):